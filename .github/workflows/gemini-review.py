@@ -1,13 +1,24 @@
+import asyncio
 import json
 import os
+import random
+import re
+import stat
 import sys
 import time
 import datetime
+import functools
+import hashlib
+import io
+import itertools
+import concurrent.futures
 import urllib.parse
-import traceback
 import logging
+import threading
+from collections import defaultdict, deque
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Iterable
+from types import MappingProxyType
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Mapping, Union
 
 # Third-party imports - these may show as unresolved in some IDEs
 # but they are required dependencies for the script
@@ -15,18 +26,59 @@ try:
     import google.generativeai as Client
     from github import Github, GithubException
     import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
     import fnmatch
     import jwt
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
     from unidiff import Hunk, PatchedFile, PatchSet
 except ImportError as e:
     print(f"Error importing required dependencies: {e}")
     print("Please install required packages: pip install PyGithub google-generativeai PyJWT requests unidiff")
     sys.exit(1)
 
+# orjson is optional; fall back to the standard library when it isn't installed
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _json_dumps_indented(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:
+    orjson = None
+    _json_loads = json.loads
+
+    def _json_dumps_indented(obj: Any) -> bytes:
+        return json.dumps(obj, indent=2).encode("utf-8")
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Shared HTTP session so calls to api.github.com reuse pooled TCP/TLS connections. Transient gateway
+# errors are retried on the pooled connection (idempotent methods only, so token POSTs aren't replayed).
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504)),
+))
+# Headers shared by every GitHub API call; Authorization is added once a token is obtained
+_session.headers.update({
+    'Accept': 'application/vnd.github+json',
+    'Accept-Encoding': 'gzip',
+    'User-Agent': 'zen-ai-router-worker',
+    'X-GitHub-Api-Version': '2022-11-28'
+})
+
+# Per-request override for endpoints that should return a raw unified diff
+DIFF_REQUEST_HEADERS = {'Accept': 'application/vnd.github.v3.diff'}
+
+
+def get_session() -> requests.Session:
+    """Return the shared HTTP session used for direct GitHub API calls."""
+    return _session
+
+
 class GitHubAuthenticator:
     """
     Centralized class for handling GitHub authentication.
@@ -38,6 +90,15 @@ class GitHubAuthenticator:
         self.installation_id = os.environ.get("ZEN_APP_INSTALLATION_ID")
         self.token = None
         self.client = None
+        # Cached token and its expiry (epoch seconds) so repeated authenticate() calls
+        # don't re-sign a JWT and re-exchange it for an installation token
+        self._cached_token = None
+        self._token_expiry = 0.0
+        # True once the client is authenticated as the GitHub App (bot identity) rather than GITHUB_TOKEN
+        self.is_app_authenticated = False
+        # Read the PEM once; the parsed key object is built on first use and reused for signing
+        self._private_key_pem = self.get_private_key()
+        self._private_key_obj = None
 
     def get_private_key(self):
         """
@@ -63,6 +124,16 @@ class GitHubAuthenticator:
 
         return None
 
+    def get_signing_key(self):
+        """
+        Return the parsed RSA private key, loading it from the cached PEM on first use.
+
+        Passing the key object to jwt.encode avoids re-parsing the PEM on every signature.
+        """
+        if self._private_key_obj is None and self._private_key_pem:
+            self._private_key_obj = load_pem_private_key(self._private_key_pem.encode('utf-8'), password=None)
+        return self._private_key_obj
+
     def generate_jwt_token(self):
         """
         Generate a JWT token for GitHub App authentication.
@@ -71,7 +142,7 @@ class GitHubAuthenticator:
             str: JWT token for GitHub App authentication or None if failed
         """
         try:
-            private_key = self.get_private_key()
+            private_key = self.get_signing_key()
             if not private_key:
                 logger.error("No private key available for GitHub App authentication")
                 return None
@@ -94,8 +165,7 @@ class GitHubAuthenticator:
             logger.info(f"Successfully generated JWT token for GitHub App ID: {self.app_id}")
             return jwt_token
         except Exception as e:
-            logger.error("Error generating JWT token: %s", e, exc_info=True)
-            traceback.print_exc()
+            logger.exception("Error generating JWT token: %s", e)
             return None
 
     def get_installation_access_token(self, jwt_token):
@@ -113,30 +183,34 @@ class GitHubAuthenticator:
                 logger.error("ZEN_APP_INSTALLATION_ID environment variable is required for GitHub App authentication")
                 return None
 
-            headers = {
-                'Authorization': f'Bearer {jwt_token}',
-                'Accept': 'application/vnd.github+json',
-                'X-GitHub-Api-Version': '2022-11-28'
-            }
-
+            # The JWT only authorizes this exchange; the session's other default headers still apply
             url = f'https://api.github.com/app/installations/{self.installation_id}/access_tokens'
-            response = requests.post(url, headers=headers)
+            response = get_session().post(url, headers={'Authorization': f'Bearer {jwt_token}'}, timeout=30)
 
             if response.status_code != 201:
                 logger.error(f"Error getting installation access token. Status code: {response.status_code}")
                 logger.error(f"Response: {response.text}")
                 return None
 
-            access_token = response.json().get('token')
+            token_data = response.json()
+            access_token = token_data.get('token')
             if not access_token:
                 logger.error("No access token found in the response")
                 return None
 
+            # Installation tokens are valid for one hour; use the reported expiry when present
+            self._token_expiry = time.time() + 55 * 60
+            expires_at = token_data.get('expires_at')
+            if expires_at:
+                try:
+                    self._token_expiry = datetime.datetime.fromisoformat(expires_at.replace('Z', '+00:00')).timestamp()
+                except ValueError:
+                    logger.warning(f"Could not parse installation token expiry: {expires_at}")
+
             logger.info(f"Successfully obtained installation access token for installation ID: {self.installation_id}")
             return access_token
         except Exception as e:
-            logger.error("Error getting installation access token: %s", e, exc_info=True)
-            traceback.print_exc()
+            logger.exception("Error getting installation access token: %s", e)
             return None
 
     def authenticate(self):
@@ -154,8 +228,12 @@ class GitHubAuthenticator:
             logger.info("Test mode: Skipping GitHub authentication")
             return None, None
 
+        # Reuse the cached token until shortly before it expires
+        if self._cached_token and time.time() < self._token_expiry - 60:
+            return self.client, self._cached_token
+
         # Try GitHub App authentication first if credentials are available
-        private_key = self.get_private_key()
+        private_key = self._private_key_pem
         if self.app_id and self.installation_id and private_key:
             logger.info("GitHub App authentication credentials found. Using GitHub App authentication.")
 
@@ -176,12 +254,15 @@ class GitHubAuthenticator:
                             logger.info("Using GitHub App installation token for authentication")
                             self.token = installation_token
                             self.client = Github(installation_token)
+                            self._cached_token = installation_token
+                            self.is_app_authenticated = True
+                            get_session().headers['Authorization'] = f'token {installation_token}'
                             return self.client, self.token
                     except Exception as e:
-                        logger.error("Error getting installation access token: %s", e, exc_info=True)
+                        logger.exception("Error getting installation access token: %s", e)
                         logger.info("Falling back to GITHUB_TOKEN due to installation token error")
             except Exception as e:
-                logger.error("Error during JWT token generation: %s", e, exc_info=True)
+                logger.exception("Error during JWT token generation: %s", e)
                 logger.info("Falling back to GITHUB_TOKEN due to JWT generation error")
         else:
             # Log specific reason for not using GitHub App authentication
@@ -202,8 +283,16 @@ class GitHubAuthenticator:
 
         self.token = github_token
         self.client = Github(github_token)
+        # GITHUB_TOKEN is valid for the whole job
+        self._cached_token = github_token
+        self._token_expiry = float('inf')
+        self.is_app_authenticated = False
+        get_session().headers['Authorization'] = f'token {github_token}'
         return self.client, self.token
 
+# Substrings that identify a Gemini rate limit / quota error, matched in one case-insensitive pass
+_RATE_LIMIT_RE = re.compile(r"429|quota|rate[ _-]?limit|resource[ _]?exhausted", re.IGNORECASE)
+
 # Initialize Gemini client
 class GeminiKeyManager:
     """
@@ -219,9 +308,10 @@ class GeminiKeyManager:
             logger.error("GEMINI_API_KEY environment variable is required")
             raise ValueError("GEMINI_API_KEY environment variable is required")
 
-        # Set current key to primary initially
-        self.current_key = self.primary_key
-        self.current_key_name = "GEMINI_API_KEY"
+        # The active (name, key) pair is swapped as one reference so readers never need a lock;
+        # only rotate_key() takes self._lock to serialize writers
+        self._lock = threading.Lock()
+        self._current = ("GEMINI_API_KEY", self.primary_key)
 
         # Track rate limited keys and rotation order
         self.rate_limited_keys = set()
@@ -229,53 +319,87 @@ class GeminiKeyManager:
         self.all_keys_rate_limited = False
         self.used_fallback_key = False
 
-        # Define rotation order: primary, then fallback if available
-        self.rotation_order = ["GEMINI_API_KEY"]
+        # Rotation order: primary, then fallback, then GEMINI_ALT_1..4. Only keys that are actually
+        # set are listed, and rotation walks this list by index.
+        self._keys = {"GEMINI_API_KEY": self.primary_key}
         if self.fallback_key:
-            self.rotation_order.append("GEMINI_FALLBACK_API_KEY")
+            self._keys["GEMINI_FALLBACK_API_KEY"] = self.fallback_key
             logger.info("Fallback API key is available for rotation.")
-        else:
-            logger.warning("No GEMINI_FALLBACK_API_KEY found. API key rotation will not be available.")
+        alt_keys = {name: value for name in (f"GEMINI_ALT_{i}" for i in range(1, 5))
+                    if (value := os.environ.get(name))}
+        if alt_keys:
+            self._keys.update(alt_keys)
+            logger.info("Alternative API keys available for rotation: %s", ", ".join(alt_keys))
+        if len(self._keys) == 1:
+            logger.warning("No GEMINI_FALLBACK_API_KEY or GEMINI_ALT_* keys found. API key rotation will not be available.")
+        self.rotation_order = list(self._keys)
+        self._current_idx = 0
 
         # Log initialization status
         logger.info(f"Initialized GeminiKeyManager with primary key and {'a fallback key' if self.fallback_key else 'no fallback key'}")
 
+    @property
+    def current_key(self):
+        return self._current[1]
+
+    @property
+    def current_key_name(self):
+        return self._current[0]
+
     def get_current_key(self):
         """Get the currently active API key."""
-        return self.current_key
+        return self._current[1]
 
     def get_current_key_name(self):
         """Get the name of the currently active API key."""
-        return self.current_key_name
+        return self._current[0]
 
     def get_key_by_name(self, key_name):
         """Get an API key by its name."""
+        return self._keys.get(key_name)
+
+    def describe_current_key(self):
+        """Describe the active key for review metadata and summaries (never exposes the key itself)."""
+        key_name = self.current_key_name
         if key_name == "GEMINI_API_KEY":
-            return self.primary_key
-        elif key_name == "GEMINI_FALLBACK_API_KEY":
-            return self.fallback_key
-        return None
+            return "primary"
+        if key_name == "GEMINI_FALLBACK_API_KEY":
+            return "fallback (rotated due to rate limiting)"
+        return f"{key_name} (rotated due to rate limiting)"
 
-    def rotate_key(self):
+    def rotate_key(self, failed_key_name=None):
         """
         Rotate to the next available API key in sequence.
-        Returns True if rotation was successful, False if no more keys are available.
+
+        failed_key_name is the key the rate-limited call used. If another call has already
+        rotated away from it, this is a no-op, so concurrent failures on one key only rotate
+        (and blacklist) once.
+        Returns True if a different key is now current, False if no more keys are available.
         """
-        self.rate_limited_keys.add(self.current_key_name)
-        self.encountered_rate_limiting = True # Ensure this flag is set
-
-        # Attempt to rotate to the fallback key if available and not already rate-limited
-        if self.fallback_key and "GEMINI_FALLBACK_API_KEY" not in self.rate_limited_keys:
-            logger.info(f"Rotating from {self.current_key_name} to GEMINI_FALLBACK_API_KEY due to rate limiting")
-            self.current_key = self.fallback_key
-            self.current_key_name = "GEMINI_FALLBACK_API_KEY"
-            self.used_fallback_key = True
-            return True
-        else:
-            # If fallback is not available or already rate-limited, all keys are exhausted
+        with self._lock:
+            if failed_key_name is not None and failed_key_name != self.current_key_name:
+                logger.debug(f"{failed_key_name} was already rotated out; now using {self.current_key_name}")
+                return True
+
+            self.rate_limited_keys.add(self.current_key_name)
+            self.encountered_rate_limiting = True # Ensure this flag is set
+
+            # Move to the next key in rotation order that isn't already rate-limited
+            num_keys = len(self.rotation_order)
+            for step in range(1, num_keys):
+                idx = (self._current_idx + step) % num_keys
+                key_name = self.rotation_order[idx]
+                if key_name not in self.rate_limited_keys:
+                    logger.info(f"Rotating from {self.current_key_name} to {key_name} due to rate limiting")
+                    self._current_idx = idx
+                    self._current = (key_name, self._keys[key_name])
+                    self.used_fallback_key = True
+                    return True
+
+            # Every key is rate-limited (or there is no other key)
             logger.warning("All available API keys are rate limited or unavailable. Resetting to primary key.")
-            self.current_key = self.primary_key
-            self.current_key_name = "GEMINI_API_KEY"
+            self._current_idx = 0
+            self._current = ("GEMINI_API_KEY", self.primary_key)
             self.all_keys_rate_limited = True # Mark that all keys were rate limited
             self.rate_limited_keys.clear() # Clear the set to try again
             self.used_fallback_key = False # Reset fallback flag
@@ -285,13 +409,7 @@ class GeminiKeyManager:
         """
         Check if an error is a rate limit error.
         """
-        error_str = str(error).lower()
-        is_rate_limit = (
-            "429" in error_str or
-            "quota" in error_str or
-            "rate limit" in error_str or
-            "resourceexhausted" in error_str
-        )
+        is_rate_limit = bool(_RATE_LIMIT_RE.search(str(error)))
 
         if is_rate_limit:
             # Mark that we've encountered rate limiting
@@ -304,6 +422,16 @@ class GeminiKeyManager:
 
 # Global instance of the key manager
 gemini_key_manager = None
+# Key the SDK is currently configured with, so configure() only runs when the key actually changes
+_configured_gemini_key = None
+
+
+def configure_gemini_key(api_key: str):
+    """Point the Gemini SDK at api_key, unless it is already configured with it."""
+    global _configured_gemini_key
+    if api_key != _configured_gemini_key:
+        Client.configure(api_key=api_key)
+        _configured_gemini_key = api_key
 
 def initialize_gemini_client():
     """
@@ -325,35 +453,53 @@ def initialize_gemini_client():
     gemini_key_manager = GeminiKeyManager()
 
     # Configure the client with the initial key
-    Client.configure(api_key=gemini_key_manager.get_current_key())
+    configure_gemini_key(gemini_key_manager.get_current_key())
     return Client
 
-# Initialize clients
-try:
-    # Create authenticator instance
-    authenticator = GitHubAuthenticator()
+# Clients are created on first use by get_clients(), not at import time
+authenticator = None
+gh = None
+github_token = None
+gemini_client_module = None
 
-    # Authenticate and get GitHub client
-    gh, github_token = authenticator.authenticate()
 
-    # Initialize Gemini client
-    gemini_client_module = initialize_gemini_client()
+@functools.lru_cache(maxsize=1)
+def get_clients():
+    """
+    Authenticate with GitHub and initialize the Gemini client, once per process.
 
-    logger.info("Successfully initialized GitHub and Gemini clients")
-except ValueError as e:
-    logger.error("Initialization error: %s", e, exc_info=True)
-    sys.exit(1)
-except Exception as e:
-    logger.error("Unexpected error during initialization: %s", e, exc_info=True)
-    traceback.print_exc()
-    sys.exit(1)
+    Sets the module-level authenticator, gh, github_token and gemini_client_module used throughout
+    this script, and returns (gh, github_token, gemini_client_module). Exits the process if
+    initialization fails.
+    """
+    global authenticator, gh, github_token, gemini_client_module
+    try:
+        # Create authenticator instance
+        authenticator = GitHubAuthenticator()
+
+        # Authenticate and get GitHub client
+        gh, github_token = authenticator.authenticate()
+
+        # Initialize Gemini client
+        gemini_client_module = initialize_gemini_client()
+
+        logger.info("Successfully initialized GitHub and Gemini clients")
+    except ValueError as e:
+        logger.error("Initialization error: %s", e, exc_info=True)
+        sys.exit(1)
+    except Exception as e:
+        logger.exception("Unexpected error during initialization: %s", e)
+        sys.exit(1)
+    return gh, github_token, gemini_client_module
 
 
 class ReviewContext:
     def __init__(self, owner: str, repo_name_str: str, event_type: str, repo_obj=None,
                  pull_number: Optional[int] = None, pr_obj=None,
                  commit_sha: Optional[str] = None, commit_obj=None,
-                 title: Optional[str] = None, description: Optional[str] = None):
+                 title: Optional[str] = None, description: Optional[str] = None,
+                 is_bot_client: bool = False, action: Optional[str] = None,
+                 head_sha: Optional[str] = None, base_sha: Optional[str] = None):
         self.owner = owner
         self.repo_name = repo_name_str
         self.event_type = event_type
@@ -364,6 +510,13 @@ class ReviewContext:
         self.commit_obj = commit_obj
         self.title = title
         self.description = description
+        # Whether repo_obj/pr_obj/commit_obj were fetched with the GitHub App (bot) client
+        self.is_bot_client = is_bot_client
+        # Webhook action of the triggering event (e.g. "opened", "synchronize"), if any
+        self.action = action
+        # Head/base commit SHAs, snapshotted once so later stages don't re-walk PyGithub objects
+        self.head_sha = head_sha
+        self.base_sha = base_sha
 
     def get_full_repo_name(self):
         return f"{self.owner}/{self.repo_name}"
@@ -374,15 +527,17 @@ def get_review_context() -> ReviewContext:
         logger.error("Error: GITHUB_EVENT_PATH environment variable not set.")
         sys.exit(1)
 
-    with open(github_event_path, "r", encoding="utf-8") as f:
-        event_data = json.load(f)
+    with open(github_event_path, "rb") as f:
+        event_data = _json_loads(f.read())
 
     event_name = os.environ.get("GITHUB_EVENT_NAME")
+    is_bot_client = bool(authenticator and authenticator.is_app_authenticated)
     repo_full_name = event_data["repository"]["full_name"]
     owner, repo_name_str = repo_full_name.split("/")
     repo_obj = None
     try:
-        repo_obj = gh.get_repo(repo_full_name) if gh else None
+        # Lazy: the repository itself is never read, only used to reach its PRs, commits and compares
+        repo_obj = gh.get_repo(repo_full_name, lazy=True) if gh else None
     except GithubException as e:
         logger.error("Error accessing GitHub repository: %s", e, exc_info=True)
         sys.exit(1)
@@ -391,7 +546,9 @@ def get_review_context() -> ReviewContext:
         sys.exit(1)
 
     if event_name == "pull_request":
-        pull_number = event_data["pull_request"]["number"]
+        # The webhook payload already carries the PR's number, title, body and both SHAs
+        pr_payload = event_data["pull_request"]
+        pull_number = pr_payload["number"]
         pr_obj = None
         try:
             pr_obj = repo_obj.get_pull(pull_number) if repo_obj else None
@@ -402,11 +559,13 @@ def get_review_context() -> ReviewContext:
             logger.error("An unexpected error occurred while fetching PR details: %s", e, exc_info=True)
             sys.exit(1)
 
-        pr_title = pr_obj.title if pr_obj else ""
-        pr_body = pr_obj.body if pr_obj else ""
-        logger.info(f"Detected event type: pull_request (action: {event_data.get('action')})")
+        pr_title = pr_payload.get("title") or ""
+        pr_body = pr_payload.get("body")
+        action = event_data.get("action")
+        logger.info(f"Detected event type: pull_request (action: {action})")
         return ReviewContext(owner, repo_name_str, "pull_request", repo_obj, pull_number, pr_obj,
-                             title=pr_title, description=pr_body)
+                             title=pr_title, description=pr_body, is_bot_client=is_bot_client,
+                             action=action, head_sha=pr_payload["head"]["sha"], base_sha=pr_payload["base"]["sha"])
 
     elif event_name == "push":
         commit_sha = os.environ.get("GITHUB_SHA")
@@ -428,8 +587,9 @@ def get_review_context() -> ReviewContext:
         commit_message = commit_obj.commit.message if commit_obj and commit_obj.commit else ""
         logger.info(f"Detected event type: push. Commit SHA: {commit_sha}")
         return ReviewContext(owner, repo_name_str, "push", repo_obj,
-                             commit_sha=commit_sha, commit_obj=commit_obj,
-                             title=f"Commit: {commit_message.splitlines()[0] if commit_message.strip() else 'No Commit Title'}", description=commit_message)
+                             commit_sha=commit_sha, commit_obj=commit_obj, head_sha=commit_sha,
+                             title=f"Commit: {commit_message.splitlines()[0] if commit_message.strip() else 'No Commit Title'}", description=commit_message,
+                             is_bot_client=is_bot_client)
 
     elif event_name == "issue_comment":
         if "issue" in event_data and "pull_request" in event_data["issue"]:
@@ -444,7 +604,9 @@ def get_review_context() -> ReviewContext:
             pr_body = pr_obj.body if pr_obj else ""
             logger.info(f"Detected event type: issue_comment on PR #{pull_number}")
             return ReviewContext(owner, repo_name_str, "issue_comment", repo_obj, pull_number, pr_obj,
-                                 title=pr_title, description=pr_body)
+                                 title=pr_title, description=pr_body, is_bot_client=is_bot_client,
+                                 head_sha=pr_obj.head.sha if pr_obj else None,
+                                 base_sha=pr_obj.base.sha if pr_obj else None)
         else:
             logger.error("Error: issue_comment event not on a pull request.")
             sys.exit(1)
@@ -453,7 +615,105 @@ def get_review_context() -> ReviewContext:
         sys.exit(1)
 
 
-def get_diff(review_context: ReviewContext, comparison_sha: Optional[str] = None) -> str:
+# Optional on-disk cache of fetched diffs and their ETags (e.g. a directory persisted with actions/cache).
+# Re-fetches then send If-None-Match, and a 304 (which doesn't count against the rate limit) is served
+# from the cached copy. Disabled when unset.
+DIFF_CACHE_DIR = os.environ.get("DIFF_CACHE_DIR", "")
+
+
+def _diff_cache_paths(api_url: str):
+    """Return the (etag, diff) cache file paths for `api_url`, or None when caching is disabled."""
+    if not DIFF_CACHE_DIR:
+        return None
+    stem = hashlib.sha256(api_url.encode("utf-8")).hexdigest()[:32]
+    return Path(DIFF_CACHE_DIR) / f"{stem}.etag", Path(DIFF_CACHE_DIR) / f"{stem}.diff"
+
+
+def _tee_lines(lines: Iterable[str], out) -> Iterator[str]:
+    """Yield `lines` unchanged while writing each one to `out`."""
+    for line in lines:
+        out.write(line)
+        yield line
+
+
+def fetch_diff_via_api(api_url: str) -> Optional[PatchSet]:
+    """
+    Request `api_url` as a raw unified diff and parse it while streaming.
+
+    With DIFF_CACHE_DIR set, the request is conditional on the cached ETag and a 304 is parsed from
+    the cached copy. Returns the parsed PatchSet, or None if authentication or the request failed.
+    """
+    # The module-level authenticator caches its token and sets it on the shared session
+    session = get_session()
+    try:
+        _, token = authenticator.authenticate()
+
+        if not token:
+            # Last resort: try to use GITHUB_TOKEN directly
+            github_token = os.environ.get("GITHUB_TOKEN")
+            if github_token:
+                logger.warning("Using GITHUB_TOKEN directly for API request as authenticator failed")
+                session.headers['Authorization'] = f'token {github_token}'
+            else:
+                logger.error("No authentication token available for API request")
+                return None
+    except Exception as auth_error:
+        logger.error(f"Authentication error for direct API request: {auth_error}")
+        # Last resort: try to use GITHUB_TOKEN directly
+        github_token = os.environ.get("GITHUB_TOKEN")
+        if github_token:
+            logger.warning("Using GITHUB_TOKEN directly for API request after authentication error")
+            session.headers['Authorization'] = f'token {github_token}'
+        else:
+            logger.error("No authentication token available for API request")
+            return None
+
+    # Make the API request
+    try:
+        # Feed the streamed body to unidiff line by line, so the whole diff is never held as one
+        # string (plus its splitlines() copy) next to the parsed PatchSet
+        cache_paths = _diff_cache_paths(api_url)
+        headers = DIFF_REQUEST_HEADERS
+        if cache_paths and cache_paths[0].is_file() and cache_paths[1].is_file():
+            headers = {**DIFF_REQUEST_HEADERS, 'If-None-Match': cache_paths[0].read_text().strip()}
+
+        with session.get(api_url, headers=headers, timeout=30, stream=True) as response:
+            if response.status_code == 304:
+                logger.info("Diff unchanged since it was cached (304); parsing cached copy for %s", api_url)
+                with open(cache_paths[1], 'r', encoding='utf-8', errors='replace', newline='\n') as f:
+                    return PatchSet(skip_removed_file_diffs(f))
+            response.raise_for_status()
+            # Decode gzip transparently, and keep urllib3 from closing the stream under TextIOWrapper at EOF
+            response.raw.decode_content = True
+            response.raw.auto_close = False
+            diff_lines = io.TextIOWrapper(response.raw, encoding='utf-8', errors='replace', newline='\n')
+            etag = response.headers.get('ETag')
+            if cache_paths and etag:
+                # Write the diff to the cache while unidiff consumes it, then publish it with its ETag
+                ensure_directory(str(cache_paths[1].parent))
+                tmp_path = cache_paths[1].with_suffix('.tmp')
+                try:
+                    with open(tmp_path, 'w', encoding='utf-8', newline='') as out:
+                        patch_set = PatchSet(skip_removed_file_diffs(_tee_lines(diff_lines, out)))
+                    # Drop the old ETag first so it can never be paired with the new diff
+                    cache_paths[0].unlink(missing_ok=True)
+                    os.replace(tmp_path, cache_paths[1])
+                finally:
+                    # Don't leave a partial copy behind if streaming or parsing failed
+                    tmp_path.unlink(missing_ok=True)
+                cache_paths[0].write_text(etag)
+            else:
+                patch_set = PatchSet(skip_removed_file_diffs(diff_lines))
+        logger.info("Retrieved diff (%d patched files) via direct API call to %s", len(patch_set), api_url)
+        return patch_set
+    except requests.exceptions.RequestException as e:
+        logger.error("Failed to get diff via direct API call: %s", e, exc_info=True)
+    except Exception as e:
+        logger.error("Unexpected error during direct API call for diff: %s", e, exc_info=True)
+    return None
+
+
+def get_diff(review_context: ReviewContext, comparison_sha: Optional[str] = None) -> Union[str, PatchSet]:
     """
     Get the diff for a PR, with multiple fallback strategies.
 
@@ -462,43 +722,62 @@ def get_diff(review_context: ReviewContext, comparison_sha: Optional[str] = None
         comparison_sha: Optional SHA to compare against HEAD
 
     Returns:
-        str: The diff text or empty string if all methods fail
+        str | PatchSet: The diff text, a PatchSet already parsed from a streamed API
+        response (direct API strategies), or empty string if all methods fail
     """
     repo = review_context.repo_obj
     pr = review_context.pr_obj
-    head_sha = None
-    if review_context.event_type == "pull_request" and review_context.pr_obj:
-        head_sha = review_context.pr_obj.head.sha
-    elif review_context.event_type == "push" and review_context.commit_obj:
-        head_sha = review_context.commit_sha # Use the current commit SHA for push events
+    head_sha = review_context.head_sha
+
+    repo_api_url = f"https://api.github.com/repos/{review_context.get_full_repo_name()}"
+
+    # Strategy 1: Ask GitHub for the raw unified diff in a single request, parsed while streaming:
+    # the PR diff for a full-PR review, otherwise the compare endpoint for the requested range.
+    # This needs no per-file requests or diff-header synthesis.
+    if review_context.pull_number and (not comparison_sha or comparison_sha == review_context.base_sha):
+        logger.info("Getting full diff for PR #%s via direct API request", review_context.pull_number)
+        patch_set = fetch_diff_via_api(f"{repo_api_url}/pulls/{review_context.pull_number}")
+    elif comparison_sha and head_sha:
+        logger.info("Getting diff of %s...%s via direct API request", comparison_sha, head_sha)
+        patch_set = fetch_diff_via_api(f"{repo_api_url}/compare/{comparison_sha}...{head_sha}")
+    else:
+        patch_set = None
+    if patch_set is not None:
+        return patch_set
+    logger.warning("Direct diff request failed or not applicable. Falling back.")
 
-    # Strategy 1: Use repo.compare if comparison_sha is provided
+    # Strategy 2: Use repo.compare if comparison_sha is provided
     if comparison_sha:
-        logger.info(f"Getting diff comparing HEAD ({head_sha}) against specified SHA ({comparison_sha})")
+        logger.info("Getting diff comparing HEAD (%s) against specified SHA (%s)", head_sha, comparison_sha)
         try:
             comparison_obj = repo.compare(comparison_sha, head_sha) if repo and head_sha else None
             diff_parts = []
             # Ensure comparison_obj is not None before accessing its 'files' attribute
             if comparison_obj and comparison_obj.files:
                 for file_diff in comparison_obj.files:
-                    if file_diff.patch:
-                        # Construct a valid diff header format for unidiff
-                        source_file_path_for_header = file_diff.previous_filename if file_diff.status == 'renamed' else file_diff.filename
-                        target_file_path_for_header = file_diff.filename
+                    patch_content = file_diff.patch
+                    if not patch_content or file_diff.status == 'removed':
+                        # Binary files and pure renames carry no patch, and deleted files are never
+                        # reviewed, so don't build (and later parse) a diff for them
+                        continue
 
-                    diff_header = f"diff --git a/{source_file_path_for_header} b/{target_file_path_for_header}\n"
+                    # Construct a valid diff header format for unidiff
+                    source_file_path_for_header = file_diff.previous_filename if file_diff.status == 'renamed' else file_diff.filename
+                    target_file_path_for_header = file_diff.filename
+
+                    header_lines = [f"diff --git a/{source_file_path_for_header} b/{target_file_path_for_header}"]
                     if file_diff.status == 'added':
-                        diff_header += f"new file mode {getattr(file_diff, 'mode', '100644')}\n"
-                        diff_header += f"index 0000000..{file_diff.sha[:7]}\n"
+                        header_lines.append(f"new file mode {getattr(file_diff, 'mode', '100644')}")
+                        header_lines.append(f"index 0000000..{file_diff.sha[:7]}")
                     elif file_diff.status == 'deleted':
-                        diff_header += f"deleted file mode {getattr(file_diff, 'mode', '100644')}\n"
-                        diff_header += f"index {file_diff.sha[:7]}..0000000\n"
+                        header_lines.append(f"deleted file mode {getattr(file_diff, 'mode', '100644')}")
+                        header_lines.append(f"index {file_diff.sha[:7]}..0000000")
                     elif file_diff.status == 'renamed':
-                        diff_header += f"similarity index {getattr(file_diff, 'similarity_index', '100')}%\n"
-                        diff_header += f"rename from {source_file_path_for_header}\n" # already set as prev_filename
-                        diff_header += f"rename to {target_file_path_for_header}\n"   # already set as filename
+                        header_lines.append(f"similarity index {getattr(file_diff, 'similarity_index', '100')}%")
+                        header_lines.append(f"rename from {source_file_path_for_header}") # already set as prev_filename
+                        header_lines.append(f"rename to {target_file_path_for_header}")   # already set as filename
                         if hasattr(file_diff, 'sha'): # If it's a rename with modifications
-                             diff_header += f"index {getattr(file_diff, 'previous_sha', '0000000')[:7]}..{file_diff.sha[:7]}\n"
+                             header_lines.append(f"index {getattr(file_diff, 'previous_sha', '0000000')[:7]}..{file_diff.sha[:7]}")
                     elif file_diff.status == 'modified':
                          # For modified files, the index line shows old SHA..new SHA
                          # PyGithub's file_diff.sha is the new SHA. We need the old one if available,
@@ -506,41 +785,34 @@ def get_diff(review_context: ReviewContext, comparison_sha: Optional[str] = None
                          # For simplicity, we'll rely on the patch content for modified index line.
                          pass
 
-                    patch_content = file_diff.patch
-
-                    # Ensure --- and +++ lines are present, this is critical for unidiff
-                    # The patch from GitHub API usually has these, but repo.compare() might be different.
-                    lines = patch_content.splitlines()
-                    final_patch_lines = []
-
-                    # Simplification: Assume file_diff.patch from repo.compare is the core hunk data
-                    # and we need to wrap it correctly for unidiff.
-                    final_patch_lines.append(f"--- a/{source_file_path_for_header}")
-                    final_patch_lines.append(f"+++ b/{target_file_path_for_header}")
-                    final_patch_lines.extend(lines) # Add the actual patch lines (hunks)
+                    # file_diff.patch from repo.compare() is only the hunk data, so add the
+                    # --- and +++ lines unidiff requires. The patch is appended as-is rather
+                    # than split into lines and re-joined.
+                    header_lines.append(f"--- a/{source_file_path_for_header}")
+                    header_lines.append(f"+++ b/{target_file_path_for_header}")
+                    header_lines.append(patch_content.rstrip("\n"))
 
-                    diff_parts.append(diff_header + "\n".join(final_patch_lines))
+                    diff_parts.append("\n".join(header_lines))
 
             if diff_parts:
                 diff_text = "\n".join(diff_parts) # Each element in diff_parts is a full diff for one file
-                logger.info(f"Retrieved diff (length: {len(diff_text)}) using repo.compare('{comparison_sha}', '{head_sha}')")
+                logger.info("Retrieved diff (length: %d) using repo.compare('%s', '%s')", len(diff_text), comparison_sha, head_sha)
                 return diff_text
             else:
-                logger.info(f"No changes found comparing {comparison_sha} to {head_sha}")
+                logger.info("No changes found comparing %s to %s", comparison_sha, head_sha)
                 return ""
         except GithubException as e:
             logger.warning(f"Error getting comparison diff (compare {comparison_sha} vs {head_sha}): {e}. Falling back.")
         except Exception as e:
-            logger.error("Unexpected error during repo.compare: %s. Falling back.", e, exc_info=True)
-            traceback.print_exc()
+            logger.exception("Unexpected error during repo.compare: %s. Falling back.", e)
 
-    # Strategy 2: Use pr.get_diff() (only for PRs)
+    # Strategy 3: Use pr.get_diff() (only for PRs)
     if review_context.event_type == "pull_request" and review_context.pr_obj:
-        logger.info(f"Falling back to pr.get_diff() for PR #{review_context.pull_number}")
+        logger.info("Falling back to pr.get_diff() for PR #%s", review_context.pull_number)
         try:
             diff_text = review_context.pr_obj.get_diff() # This is usually well-formatted for unidiff
             if diff_text:
-                logger.info(f"Retrieved diff (length: {len(diff_text)}) using pr.get_diff()")
+                logger.info("Retrieved diff (length: %d) using pr.get_diff()", len(diff_text))
                 return diff_text
             else:
                 logger.warning("pr.get_diff() returned no content.")
@@ -550,173 +822,158 @@ def get_diff(review_context: ReviewContext, comparison_sha: Optional[str] = None
         except Exception as e:
             logger.error("Unexpected error during pr.get_diff(): %s. Falling back further.", e, exc_info=True)
 
-    # Strategy 3: Use direct API request with proper authentication
-    # This strategy can be adapted for both PRs and commits if needed, but for now,
-    # it's primarily used as a fallback for PR diffs.
-    api_url = ""
-    if review_context.event_type == "pull_request" and review_context.pull_number:
-        logger.info(f"Falling back to direct API request for PR diff for PR #{review_context.pull_number}")
-        api_url = f"https://api.github.com/repos/{review_context.get_full_repo_name()}/pulls/{review_context.pull_number}"
-    elif review_context.event_type == "push" and comparison_sha and review_context.commit_sha:
-        logger.info(f"Falling back to direct API request for commit diff for {review_context.commit_sha}")
-        # For commits, GitHub API provides a compare endpoint:
-        # GET /repos/{owner}/{repo}/compare/{basehead}
-        api_url = f"https://api.github.com/repos/{review_context.get_full_repo_name()}/compare/{comparison_sha}...{review_context.commit_sha}"
-    else:
-        logger.error("Cannot determine API URL for diff based on review context.")
-        return ""
+    logger.error("All methods to retrieve diff failed.")
+    return ""
 
-    # Use the global authenticator instance for authentication
-    headers = {
-        'Accept': 'application/vnd.github.v3.diff'
-    }
 
-    # Get a fresh token from the authenticator
-    try:
-        # Create a new authenticator instance for this request
-        request_auth = GitHubAuthenticator()
-        _, token = request_auth.authenticate()
+def get_hunk_representation(hunk: Hunk) -> str:
+    return str(hunk)
 
-        if token:
-            headers['Authorization'] = f'token {token}'
-        else:
-            # Last resort: try to use GITHUB_TOKEN directly
-            github_token = os.environ.get("GITHUB_TOKEN")
-            if github_token:
-                logger.warning("Using GITHUB_TOKEN directly for API request as authenticator failed")
-                headers['Authorization'] = f'token {github_token}'
-            else:
-                logger.error("No authentication token available for API request")
-                return ""
-    except Exception as auth_error:
-        logger.error(f"Authentication error for direct API request: {auth_error}")
-        # Last resort: try to use GITHUB_TOKEN directly
-        github_token = os.environ.get("GITHUB_TOKEN")
-        if github_token:
-            logger.warning("Using GITHUB_TOKEN directly for API request after authentication error")
-            headers['Authorization'] = f'token {github_token}'
-        else:
-            logger.error("No authentication token available for API request")
-            return ""
 
-    # Make the API request
-    try:
-        response = requests.get(api_url, headers=headers, timeout=30)
-        response.raise_for_status()
-        diff_text = response.text
-        logger.info(f"Retrieved diff (length: {len(diff_text)}) via direct API call.")
-        return diff_text
-    except requests.exceptions.RequestException as e:
-        logger.error("Failed to get diff via direct API call: %s", e, exc_info=True)
-    except Exception as e:
-        logger.error("Unexpected error during direct API call for diff: %s", e, exc_info=True)
+# Tuple so str.endswith can test every extension in a single call
+CODE_EXTENSIONS = (
+    ".py", ".js", ".jsx", ".ts", ".tsx", ".html", ".css", ".scss", ".java",
+    ".c", ".cpp", ".h", ".hpp", ".go", ".rs", ".php", ".rb", ".sh", ".bash",
+    ".json", ".yml", ".yaml", ".toml", ".md"
+)
 
-    logger.error("All methods to retrieve diff failed.")
-    return ""
 
+MAX_FILE_CONTEXT_CHARS = 150000
+_FILE_CONTEXT_TRUNCATION_MARKER = "\n\n... [content context truncated for brevity] ...\n\n"
 
-def get_hunk_representation(hunk: Hunk) -> str:
-    return str(hunk)
+
+@functools.lru_cache(maxsize=256)
+def _read_file_context(file_path: str, mtime_ns: int, size: int) -> str:
+    """
+    Read (and head/tail-truncate) a file for prompt context.
+
+    Cached on (path, mtime, size), so re-reviewing an unchanged file in the same process doesn't read
+    it again, while any change to the file misses the cache.
+    """
+    if size > MAX_FILE_CONTEXT_CHARS:
+        # Read only the head and tail slices we keep instead of loading the whole file
+        logger.info("File %s is too large (%d bytes), truncating for Gemini context.", file_path, size)
+        half_len = MAX_FILE_CONTEXT_CHARS // 2
+        with open(file_path, 'rb') as f:
+            head = f.read(half_len)
+            f.seek(-half_len, os.SEEK_END)
+            tail = f.read(half_len)
+        return head.decode('utf-8', errors='ignore') + _FILE_CONTEXT_TRUNCATION_MARKER + \
+               tail.decode('utf-8', errors='ignore')
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+        return f.read()
+
+
+# Full-file context is skipped when the diff's added lines already make up this share of the file
+FILE_CONTEXT_MAX_DIFF_COVERAGE = 0.8
+
+
+def diff_covers_most_of_file(patched_file: PatchedFile, file_content: str) -> bool:
+    """
+    Whether the diff already shows (nearly) the whole file, so full-file context would only repeat it.
+
+    True for newly added files, and for files whose added lines are at least FILE_CONTEXT_MAX_DIFF_COVERAGE
+    of the lines in file_content. Hunk context lines don't count, and truncated contents never qualify
+    since their line count is unknown.
+    """
+    if patched_file.is_added_file:
+        return True
+    if not file_content or _FILE_CONTEXT_TRUNCATION_MARKER in file_content:
+        return False
+    file_lines = file_content.count("\n") + (not file_content.endswith("\n"))
+    return patched_file.added >= FILE_CONTEXT_MAX_DIFF_COVERAGE * file_lines
 
 
 def get_file_content(file_path: str) -> str:
     full_file_content = ""
-    code_extensions = [
-        ".py", ".js", ".jsx", ".ts", ".tsx", ".html", ".css", ".scss", ".java",
-        ".c", ".cpp", ".h", ".hpp", ".go", ".rs", ".php", ".rb", ".sh", ".bash",
-        ".json", ".yml", ".yaml", ".toml", ".md"
-    ]
-    is_code_file = any(file_path.endswith(ext) for ext in code_extensions)
+    is_code_file = file_path.endswith(CODE_EXTENSIONS)
 
     if not is_code_file:
-        print(f"Skipping full file context for non-code or binary-like file: {file_path}")
+        logger.info("Skipping full file context for non-code or binary-like file: %s", file_path)
         return ""
 
     try:
-        p_file_path = Path(file_path)
-        if p_file_path.exists() and p_file_path.is_file():
-            file_stat = p_file_path.stat()
-            max_initial_read_bytes = 300000
-
-            if file_stat.st_size > max_initial_read_bytes:
-                print(f"File {file_path} is very large ({file_stat.st_size} bytes). Reading a truncated version for context.")
-                with open(p_file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    start_content = f.read(max_initial_read_bytes // 2)
-                full_file_content = start_content + "\n\n... [content truncated due to very large size] ...\n\n"
-            else:
-                 with open(p_file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    full_file_content = f.read()
-
-            max_char_len_for_context = 150000
-            if len(full_file_content) > max_char_len_for_context:
-                print(f"File content for {file_path} still too long after initial read ({len(full_file_content)} chars), further truncating for Gemini context.")
-                half_len = max_char_len_for_context // 2
-                full_file_content = full_file_content[:half_len] + \
-                                    "\n\n... [content context truncated for brevity] ...\n\n" + \
-                                    full_file_content[-half_len:]
-
-            print(f"Read file content for {file_path} (length: {len(full_file_content)} chars after potential truncation).")
+        # A single stat() answers "exists", "is a regular file" and "how big"
+        try:
+            file_stat = os.stat(file_path)
+        except FileNotFoundError:
+            file_stat = None
+
+        if file_stat is not None and stat.S_ISREG(file_stat.st_mode):
+            full_file_content = _read_file_context(file_path, file_stat.st_mtime_ns, file_stat.st_size)
+            logger.info("Read file content for %s (length: %d chars after potential truncation).", file_path, len(full_file_content))
         else:
-            print(f"File {file_path} does not exist locally or is not a file. Cannot provide full context.")
+            logger.info("File %s does not exist locally or is not a file. Cannot provide full context.", file_path)
     except Exception as e:
-        print(f"Error reading full file content for {file_path}: {e}")
-        traceback.print_exc()
+        logger.exception("Error reading full file content for %s: %s", file_path, e)
     return full_file_content
 
 
-def load_previous_review_data(filepath_str: str = "reviews/gemini-pr-review.json") -> Dict[str, Any]:
-    """Load previous review data from JSON file if it exists."""
+@functools.lru_cache(maxsize=4)
+def load_previous_review_data(filepath_str: str = "reviews/gemini-pr-review.json") -> Mapping[str, Any]:
+    """
+    Load previous review data from JSON file if it exists.
+
+    The result is cached per path and shared between callers, so it is returned
+    as a read-only mapping.
+    """
     filepath = Path(filepath_str)
     if not filepath.exists():
-        print(f"Previous review file {filepath_str} not found. No previous context will be provided.")
-        return {}
+        logger.info("Previous review file %s not found. No previous context will be provided.", filepath_str)
+        return MappingProxyType({})
 
     try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            print(f"Successfully loaded previous review data from {filepath_str}")
-            return data
+        with open(filepath, "rb") as f:
+            data = _json_loads(f.read())
+            logger.info("Successfully loaded previous review data from %s", filepath_str)
+            return MappingProxyType(data)
     except Exception as e:
-        print(f"Error loading previous review data from {filepath_str}: {e}")
-        return {}
+        logger.warning("Error loading previous review data from %s: %s", filepath_str, e)
+        return MappingProxyType({})
 
 
-def get_previous_file_comments(review_data: Dict[str, Any], file_path: str) -> List[Dict[str, Any]]:
-    """Extract previous comments for a specific file from the review data."""
-    if not review_data or "review_comments" not in review_data:
-        return []
+@functools.lru_cache(maxsize=4)
+def load_previous_comments_by_file(filepath_str: str = "reviews/gemini-pr-review.json") -> Mapping[str, List[Dict[str, Any]]]:
+    """
+    Group the previous review comments by file path in a single pass.
 
-    file_comments = []
+    Comments marked "[IGNORED]" are dropped while indexing. The index is cached per
+    review file so every file in the diff gets a dict lookup instead of a full scan.
+    """
+    review_data = load_previous_review_data(filepath_str)
+    comments_by_file = defaultdict(list)
     for comment in review_data.get("review_comments", []):
-        comment_text = comment.get("comment_text_md", "")
-        if comment.get("file_path") == file_path and "[IGNORED]" not in comment_text:
-            file_comments.append(comment)
-
-    print(f"Found {len(file_comments)} previous comments for file {file_path}")
-    return file_comments
-
-
-def create_batch_prompt(patched_file: PatchedFile, review_context: ReviewContext) -> str:
-    full_file_content_for_context = get_file_content(patched_file.path)
+        if "[IGNORED]" not in comment.get("comment_text_md", ""):
+            comments_by_file[comment.get("file_path")].append(comment)
+    return MappingProxyType(dict(comments_by_file))
 
-    # Load previous review data (adjust filepath based on event type)
-    review_data_filepath = "reviews/gemini-pr-review.json" if review_context.event_type == "pull_request" else "reviews/gemini-commit-review.json"
-    previous_review_data = load_previous_review_data(filepath_str=review_data_filepath)
-    previous_file_comments = get_previous_file_comments(previous_review_data, patched_file.path)
 
-    combined_hunks_text = ""
-    for i, hunk in enumerate(patched_file):
-        hunk_text = get_hunk_representation(hunk)
-        if not hunk_text.strip():
-            continue
+def get_previous_file_comments(comments_by_file: Mapping[str, List[Dict[str, Any]]], file_path: str) -> List[Dict[str, Any]]:
+    """Look up previous comments for a specific file in the indexed review data."""
+    file_comments = comments_by_file.get(file_path, [])
+    logger.info("Found %d previous comments for file %s", len(file_comments), file_path)
+    return file_comments
 
-        separator = ("-" * 20) + f" Hunk {i+1} (0-indexed: {i}) " + ("-" * 20) + "\n"
-        combined_hunks_text += ("\n\n" if i > 0 else "") + separator + hunk_text
 
+def build_review_instructions(review_context: ReviewContext, multi_file: bool = False) -> str:
+    """Build the fixed instruction preamble; multi-file prompts additionally ask for a fileIndex per review."""
     # Adjust instructions based on event type
     review_type_instruction = "pull requests" if review_context.event_type == "pull_request" else "code commits"
+    return _build_review_instructions(review_type_instruction, multi_file)
+
+
+@functools.lru_cache(maxsize=4)
+def _build_review_instructions(review_type_instruction: str, multi_file: bool) -> str:
+    # Only two inputs vary, so every prompt in a run shares one of at most four preamble strings
     # Escape any literal '%' characters in review_type_instruction for f-string
     escaped_review_type_instruction = review_type_instruction.replace('%', '%%')
+    file_index_field = ""
+    file_index_note = ""
+    if multi_file:
+        file_index_field = "\n      \"fileIndex\": 0,  // 0-based index of the file (matches the 'FILE_INDEX: K' header)"
+        file_index_note = ("\n- Several files are included, each under a 'FILE_INDEX: K' header; every review must set fileIndex"
+                           "\n- hunkIndex and lineNumber are relative to the file identified by fileIndex")
+
     instructions = f"""Your task is reviewing {escaped_review_type_instruction}. You will provide structured output in JSON format.
 
 REVIEW GUIDELINES:
@@ -753,7 +1010,7 @@ RESPONSE FORMAT:
 Your response must be a valid JSON object with the following structure:
 {{
   "reviews": [
-    {{
+    {{{file_index_field}
       "hunkIndex": 0,  // 0-based index of the hunk in the diff (matches the 'Hunk X (0-indexed: Y)' header)
       "lineNumber": 1, // 1-based line number within the hunk content (first line after the '@@ ... @@' header)
       "reviewComment": "Your review comment in GitHub Markdown format",
@@ -767,10 +1024,15 @@ IMPORTANT NOTES ABOUT LINE NUMBERS:
 - The hunkIndex must be a valid 0-based index within the range of hunks in the diff
 - The lineNumber must be a valid 1-based line number within the content of the specified hunk
 - If you're unsure about the exact line number, choose the first line of the relevant code block
-- Do not specify line numbers outside the range of the hunk content
+- Do not specify line numbers outside the range of the hunk content{file_index_note}
 
 The response will be automatically structured according to the schema provided in the API configuration.
 """
+    return instructions
+
+
+def build_review_context_block(review_context: ReviewContext) -> str:
+    """Build the PR/commit title and description block shared by every file in the review."""
 
     # Contextualize prompt based on event type
     context_header = ""
@@ -785,23 +1047,42 @@ The response will be automatically structured according to the schema provided i
         context_header = f"\nReview Context Title: {review_context.title}\nReview Context Description:\n---\n"
         context_description = review_context.description or 'No description provided.'
 
-    review_context_block = f"{context_header}{context_description}\n---\n"
+    return f"{context_header}{context_description}\n---\n"
+
+
+def build_file_review_section(patched_file: PatchedFile, review_context: ReviewContext,
+                              full_file_content_for_context: str) -> str:
+    """Build the per-file part of a prompt: previous comments, optional full file context and the hunks."""
+    # Load previous review data (adjust filepath based on event type)
+    review_data_filepath = "reviews/gemini-pr-review.json" if review_context.event_type == "pull_request" else "reviews/gemini-commit-review.json"
+    previous_comments_by_file = load_previous_comments_by_file(review_data_filepath)
+    previous_file_comments = get_previous_file_comments(previous_comments_by_file, patched_file.path)
+
+    hunk_sections = []
+    for i, hunk in enumerate(patched_file):
+        hunk_text = get_hunk_representation(hunk)
+        if not hunk_text.strip():
+            continue
+
+        separator = ("-" * 20) + f" Hunk {i+1} (0-indexed: {i}) " + ("-" * 20) + "\n"
+        hunk_sections.append(separator + hunk_text)
+    combined_hunks_text = "\n\n".join(hunk_sections)
 
     # Add previous review context if available
-    previous_review_context = ""
+    previous_review_parts = []
     if previous_file_comments:
-        previous_review_context = "\n## My Previous Review Comments for this file:\n"
+        previous_review_parts.append("\n## My Previous Review Comments for this file:\n")
         for i, comment in enumerate(previous_file_comments):
             comment_text = comment.get('comment_text_md', 'N/A')
             # Check if the comment has been marked as addressed
             is_addressed = "[ADDRESSED]" in comment_text
             status_marker = "✅ ADDRESSED" if is_addressed else "⏳ PENDING"
 
-            previous_review_context += f"### Comment {i+1}: {status_marker}\n"
-            previous_review_context += f"- **File**: {comment.get('file_path')}\n"
-            previous_review_context += f"- **Category**: {comment.get('detected_category_heuristic', 'N/A')}\n"
-            previous_review_context += f"- **Severity**: {comment.get('detected_severity_heuristic', 'N/A')}\n"
-            previous_review_context += f"- **Content**: {comment_text}\n\n"
+            previous_review_parts.append(f"### Comment {i+1}: {status_marker}\n")
+            previous_review_parts.append(f"- **File**: {comment.get('file_path')}\n")
+            previous_review_parts.append(f"- **Category**: {comment.get('detected_category_heuristic', 'N/A')}\n")
+            previous_review_parts.append(f"- **Severity**: {comment.get('detected_severity_heuristic', 'N/A')}\n")
+            previous_review_parts.append(f"- **Content**: {comment_text}\n\n")
 
             # If the comment has been addressed, try to extract the resolution note
             if is_addressed:
@@ -809,7 +1090,8 @@ The response will be automatically structured according to the schema provided i
                 resolution_text = comment_text[resolution_start:]
                 if "**Resolution**:" in resolution_text:
                     resolution_note = resolution_text.split("**Resolution**:", 1)[1].strip()
-                    previous_review_context += f"- **Resolution Note**: {resolution_note}\n\n"
+                    previous_review_parts.append(f"- **Resolution Note**: {resolution_note}\n\n")
+    previous_review_context = "".join(previous_review_parts)
 
     file_context_header = ""
     file_content_block = ""
@@ -818,32 +1100,230 @@ The response will be automatically structured according to the schema provided i
         file_ext = Path(patched_file.path).suffix[1:]
         file_content_block = f"```{file_ext or 'text'}\n{full_file_content_for_context}\n```\n"
 
-    diff_to_review_header = f"\nReview the following code diffs for the file \"{patched_file.path}\" ({len(list(patched_file))} hunks):\n"
+    diff_to_review_header = f"\nReview the following code diffs for the file \"{patched_file.path}\" ({len(patched_file)} hunks):\n"
     diff_block = f"```diff\n{combined_hunks_text}\n```"
 
-    return instructions + review_context_block + previous_review_context + file_context_header + file_content_block + diff_to_review_header + diff_block
+    return "".join((previous_review_context, file_context_header, file_content_block, diff_to_review_header, diff_block))
+
+
+def create_batch_prompt(patched_file: PatchedFile, review_context: ReviewContext,
+                        full_file_content_for_context: Optional[str] = None) -> str:
+    if full_file_content_for_context is None:
+        full_file_content_for_context = get_file_content(patched_file.path)
+
+    return build_single_file_prompt(
+        review_context, build_file_review_section(patched_file, review_context, full_file_content_for_context))
+
+
+def build_single_file_prompt(review_context: ReviewContext, file_section: str) -> str:
+    """Wrap one file's prebuilt review section with the instructions and PR context."""
+    return "".join((build_review_instructions(review_context), build_review_context_block(review_context), file_section))
+
+
+def create_multi_file_batch_prompt(patched_files: List[PatchedFile], review_context: ReviewContext,
+                                   file_sections: List[str]) -> str:
+    """
+    Build one prompt reviewing several files, so the instructions and PR context are sent once.
+
+    Each file's prebuilt section is tagged with a FILE_INDEX header that the model echoes back as fileIndex.
+    """
+    parts = [build_review_instructions(review_context, multi_file=True), build_review_context_block(review_context)]
+    for file_idx, (patched_file, file_section) in enumerate(zip(patched_files, file_sections)):
+        parts.append(f"\n{'=' * 20} FILE_INDEX: {file_idx} ({patched_file.path}) {'=' * 20}\n")
+        parts.append(file_section)
+    return "".join(parts)
 
 
-LAST_GEMINI_REQUEST_TIME = 0
 GEMINI_RPM_LIMIT = 45
-GEMINI_REQUEST_INTERVAL_SECONDS = 60.0 / GEMINI_RPM_LIMIT
+GEMINI_TPM_LIMIT = int(os.environ.get("GEMINI_TPM_LIMIT", 1_000_000))
+GEMINI_MAX_OUTPUT_TOKENS = 8192
+# Longest we wait for TPM budget before sending a prompt without the full file context instead
+GEMINI_TPM_PERMIT_TIMEOUT_SECONDS = 10.0
 
-def enforce_gemini_rate_limits():
-    global LAST_GEMINI_REQUEST_TIME
-    current_time = time.time()
-    time_since_last = current_time - LAST_GEMINI_REQUEST_TIME
-    if time_since_last < GEMINI_REQUEST_INTERVAL_SECONDS:
-        wait_time = GEMINI_REQUEST_INTERVAL_SECONDS - time_since_last
-        print(f"Gemini Rate Limiter: Waiting {wait_time:.2f} seconds.")
-        time.sleep(wait_time)
-    LAST_GEMINI_REQUEST_TIME = time.time()
+
+class TokenBucket:
+    """
+    Thread-safe token bucket mirroring Gemini's server-side quota buckets.
+
+    Holds up to `capacity` tokens and refills continuously at `refill_per_second`,
+    so bursts up to the capacity go through immediately. Waiting happens outside
+    the lock, so one throttled caller never blocks others from taking tokens.
+    """
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_per_second)
+        self.last_refill = now
+
+    def wait_time(self, amount: float = 1) -> float:
+        """How long acquire(amount) would currently have to wait, without taking any tokens."""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (amount - self.tokens) / self.refill_per_second)
+
+    def _try_take(self, amount: float) -> float:
+        """Take `amount` tokens if available and return 0, otherwise return how long until they will be."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.refill_per_second
+
+    def acquire(self, amount: float = 1) -> float:
+        """Take `amount` tokens, sleeping until they are available. Returns the total time waited."""
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while (wait_time := self._try_take(amount)) > 0:
+            time.sleep(wait_time)
+            waited += wait_time
+        return waited
+
+    async def acquire_async(self, amount: float = 1) -> float:
+        """Like acquire(), but yields to the event loop instead of blocking while waiting."""
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while (wait_time := self._try_take(amount)) > 0:
+            await asyncio.sleep(wait_time)
+            waited += wait_time
+        return waited
+
+
+# Quotas are enforced per project, and fallback/alternative keys usually belong to other projects,
+# so every key gets its own (RPM, TPM) bucket pair instead of sharing one budget
+_key_rate_limit_buckets: Dict[str, tuple] = {}
+
+
+def get_rate_limit_buckets(key_name: Optional[str] = None) -> tuple:
+    """Return the (rpm_bucket, tpm_bucket) pair for a key name, defaulting to the key currently in use."""
+    if key_name is None:
+        key_name = gemini_key_manager.get_current_key_name() if gemini_key_manager else "GEMINI_API_KEY"
+    buckets = _key_rate_limit_buckets.get(key_name)
+    if buckets is None:
+        buckets = _key_rate_limit_buckets.setdefault(key_name, (
+            TokenBucket(capacity=GEMINI_RPM_LIMIT, refill_per_second=GEMINI_RPM_LIMIT / 60.0),
+            TokenBucket(capacity=GEMINI_TPM_LIMIT, refill_per_second=GEMINI_TPM_LIMIT / 60.0),
+        ))
+    return buckets
+
+
+def estimate_prompt_tokens(prompt: str) -> int:
+    """Cheap token estimate for TPM accounting: ~4 characters per input token plus the output budget."""
+    return len(prompt) // 4 + GEMINI_MAX_OUTPUT_TOKENS
+
+
+async def enforce_gemini_rate_limits(estimated_tokens: int = 0, key_name: Optional[str] = None):
+    rpm_bucket, tpm_bucket = get_rate_limit_buckets(key_name)
+    waited = await tpm_bucket.acquire_async(estimated_tokens) if estimated_tokens else 0.0
+    waited += await rpm_bucket.acquire_async()
+    if waited:
+        logger.info("Gemini Rate Limiter: Waited %.2f seconds.", waited)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limit on in-flight Gemini calls, used as an async context manager.
+
+    The limit halves whenever a call is rate limited and grows by one after
+    `increase_after` consecutive successful calls, up to `ceiling`. Only used
+    from the event loop thread, so no locking is needed.
+    """
+    def __init__(self, initial_limit: int, ceiling: int, increase_after: int = 3):
+        self.limit = max(1, initial_limit)
+        self.ceiling = max(self.limit, ceiling)
+        self.increase_after = increase_after
+        self.in_flight = 0
+        self._consecutive_successes = 0
+        self._waiters = deque()
+
+    async def __aenter__(self):
+        while self.in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        # Woken waiters re-check the limit, so waking a few too many is harmless
+        for _ in range(max(0, self.limit - self.in_flight)):
+            if not self._waiters:
+                break
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def record_success(self):
+        self._consecutive_successes += 1
+        if self._consecutive_successes >= self.increase_after and self.limit < self.ceiling:
+            self.limit += 1
+            self._consecutive_successes = 0
+            logger.info("Gemini concurrency limit raised to %d.", self.limit)
+            self._wake_waiters()
+
+    def record_rate_limited(self):
+        self._consecutive_successes = 0
+        if self.limit > 1:
+            self.limit = max(1, self.limit // 2)
+            logger.warning("Gemini concurrency limit lowered to %d after a rate limit error.", self.limit)
+
+
+GEMINI_BACKOFF_BASE_SECONDS = 10
+GEMINI_BACKOFF_MAX_SECONDS = 60
+# Independently seeded so concurrent workers don't retry in lockstep
+_backoff_rng = random.Random(os.urandom(8))
+# Matches server hints such as "Please retry in 37.5s", "Retry-After: 30" or "retry_delay { seconds: 37 }"
+_RETRY_AFTER_RE = re.compile(r"retry(?:_delay\s*\{\s*seconds:|[ -]after:?|\s+in)\s*(\d+(?:\.\d+)?)", re.IGNORECASE)
+
+
+def get_server_retry_delay(error: Exception) -> Optional[float]:
+    """Extract the retry delay the server asked for from a Gemini API error, if it gave one."""
+    retry_delay = getattr(error, 'retry_delay', None)
+    if retry_delay is not None:
+        if isinstance(retry_delay, datetime.timedelta):
+            return retry_delay.total_seconds()
+        if isinstance(retry_delay, (int, float)):
+            return float(retry_delay)
+        if hasattr(retry_delay, 'seconds'):
+            return float(retry_delay.seconds)
+
+    match = _RETRY_AFTER_RE.search(str(error))
+    return float(match.group(1)) if match else None
+
+
+def jittered(delay: float) -> float:
+    """Spread a delay by +/-50% so retries from concurrent calls don't line up, capped at GEMINI_BACKOFF_MAX_SECONDS."""
+    return min(GEMINI_BACKOFF_MAX_SECONDS, delay * _backoff_rng.uniform(0.5, 1.5))
+
+
+def get_backoff_delay(attempt: int, error: Optional[Exception] = None) -> float:
+    """
+    Jittered exponential backoff capped at GEMINI_BACKOFF_MAX_SECONDS, never shorter than the
+    server-provided retry delay. The server delay itself is not capped: retrying before it has
+    passed would only get another 429 and spend an attempt.
+    """
+    delay = jittered(GEMINI_BACKOFF_BASE_SECONDS * (2 ** (attempt - 1)))
+    server_delay = get_server_retry_delay(error) if error is not None else None
+    if server_delay is not None:
+        delay = max(delay, server_delay)
+    return delay
 
 
 def process_structured_output(data: Dict[str, Any]) -> List[Dict[str, Any]]:
     """Process the structured output from the Gemini API."""
     # Validate the structure
     if not isinstance(data, dict) or "reviews" not in data or not isinstance(data["reviews"], list):
-        print(f"Error: Structured output has invalid structure. Expected {{'reviews': [...]}}. Got: {type(data)}")
+        logger.error("Structured output has invalid structure. Expected {'reviews': [...]}. Got: %s", type(data))
         return []
 
     # Process the reviews
@@ -851,255 +1331,425 @@ def process_structured_output(data: Dict[str, Any]) -> List[Dict[str, Any]]:
     for i, review_item in enumerate(data["reviews"]):
         # Validate the review item
         if not isinstance(review_item, dict):
-            print(f"Error: Review item {i} is not a dict: {review_item}")
+            logger.error("Review item %d is not a dict: %s", i, review_item)
             continue
 
-        required_keys = ["hunkIndex", "lineNumber", "reviewComment", "confidence"]
-        if not all(k in review_item for k in required_keys):
-            print(f"Error: Review item {i} missing one or more required keys ({', '.join(required_keys)}): {review_item}")
+        if not review_item.keys() >= REVIEW_REQUIRED_KEYS:
+            logger.error("Review item %d missing one or more required keys (%s): %s", i, ", ".join(REVIEW_ITEM_SCHEMA["required"]), review_item)
             continue
 
         # Ensure types are correct
         try:
-            # Convert to integers if needed
-            if not isinstance(review_item["hunkIndex"], int):
-                review_item["hunkIndex"] = int(review_item["hunkIndex"])
-            if not isinstance(review_item["lineNumber"], int):
-                review_item["lineNumber"] = int(review_item["lineNumber"])
+            # Convert schema integer fields to integers if needed
+            for key in REVIEW_INTEGER_KEYS:
+                if key in review_item and not isinstance(review_item[key], int):
+                    review_item[key] = int(review_item[key])
         except (ValueError, TypeError) as e:
-            print(f"Error: Review item {i} hunkIndex or lineNumber not convertible to int: {review_item}, error: {e}")
+            logger.error("Review item %d %s not convertible to int: %s, error: %s", i, ", ".join(REVIEW_INTEGER_KEYS), review_item, e)
             continue
 
         # Validate confidence
-        if review_item["confidence"] not in ["High", "Medium", "Low"]:
-            print(f"Warning: Review item {i} has invalid confidence '{review_item.get('confidence')}'. Defaulting to Low.")
+        if review_item["confidence"] not in REVIEW_CONFIDENCE_VALUES:
+            logger.warning("Review item %d has invalid confidence '%s'. Defaulting to Low.", i, review_item.get("confidence"))
             review_item["confidence"] = "Low"
 
         valid_reviews.append(review_item)
 
-    print(f"Successfully processed {len(valid_reviews)} valid review items from structured output.")
+    logger.info("Successfully processed %d valid review items from structured output.", len(valid_reviews))
     return valid_reviews
 
 
-def improved_calculate_github_position(file_patch: PatchedFile, hunk_idx: int, line_num_in_hunk: int) -> Optional[int]:
+def _index_file(patched_file: PatchedFile) -> tuple:
+    """
+    Index a file's hunks once so positions can be computed without re-walking the patch.
+
+    Returns (hunks, hunk_lens, prefix) where prefix[i] is the diff position just before
+    hunk i's header, i.e. the sum of (1 header line + body lines) over all earlier hunks.
+    """
+    # PatchedFile and Hunk are list subclasses: len() is O(1) and no copy is needed
+    hunks = patched_file
+    hunk_lens = [len(hunk) for hunk in hunks]
+    prefix = [0]
+    for hunk_len in hunk_lens:
+        prefix.append(prefix[-1] + 1 + hunk_len)
+    return hunks, hunk_lens, prefix
+
+
+def improved_calculate_github_position(prefix: List[int], hunk_lens: List[int], hunk_idx: int, line_num_in_hunk: int) -> Optional[int]:
     """
     Improved function to calculate GitHub position for a comment.
 
     This function handles line number calculation more robustly by:
-    1. Getting the actual hunk object by index
+    1. Validating the hunk index against the file's hunk index from _index_file()
     2. Validating the line number is within the hunk's content range
-    3. Calculating the position based on the hunk's position in the diff
+    3. Calculating the position from the precomputed prefix sums of hunk sizes
     """
     try:
-        # Get all hunks in the file
-        hunks_in_file = list(file_patch)
-
         # Validate hunk index
-        if not (0 <= hunk_idx < len(hunks_in_file)):
-            print(f"Warning: Invalid hunk index {hunk_idx} for file {file_patch.path} (has {len(hunks_in_file)} hunks)")
+        if not (0 <= hunk_idx < len(hunk_lens)):
+            logger.warning("Invalid hunk index %d (file has %d hunks)", hunk_idx, len(hunk_lens))
             return None
 
-        # Get the target hunk
-        target_hunk = hunks_in_file[hunk_idx]
-
-        # Get the number of lines in the hunk
-        hunk_lines = list(target_hunk)
-        num_lines_in_hunk = len(hunk_lines)
-
         # Validate line number
+        num_lines_in_hunk = hunk_lens[hunk_idx]
         if not (1 <= line_num_in_hunk <= num_lines_in_hunk):
-            print(f"Warning: Line number {line_num_in_hunk} is outside the range of hunk content (1-{num_lines_in_hunk})")
+            logger.warning("Line number %s is outside the range of hunk content (1-%d)", line_num_in_hunk, num_lines_in_hunk)
             return None
 
-        # Calculate position based on hunk position and line number
-        position = 0
+        # Positions of all earlier hunks, plus the target hunk header, plus the line within the hunk
+        return prefix[hunk_idx] + 1 + (line_num_in_hunk - 1)
 
-        # Add positions for all hunks before the target hunk
-        for i in range(hunk_idx):
-            position += 1  # For the hunk header
-            position += len(list(hunks_in_file[i]))
+    except Exception as e:
+        logger.exception("Error calculating GitHub position: %s", e)
+        return None
 
-        # Add position for the target hunk header
-        position += 1
 
-        # Add position for the line within the target hunk
-        position += line_num_in_hunk - 1
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*\n?(.*?)```", re.DOTALL | re.IGNORECASE)
+_JSON_CLOSERS = {"{": "}", "[": "]"}
+# How often each recover_json() stage produced the parsed response, for observability
+JSON_PARSE_STAGE_COUNTS = defaultdict(int)
 
-        return position
 
-    except Exception as e:
-        print(f"Error calculating GitHub position: {e}")
-        traceback.print_exc()
-        return None
+def _try_json_loads(text: str) -> tuple:
+    """Returns (data, True) if text parses as JSON, otherwise (None, False)."""
+    try:
+        return _json_loads(text), True
+    except ValueError:
+        return None, False
+
+
+def _scan_json_object(text: str) -> tuple:
+    """
+    Scan from the first '{' and return (span, open_brackets).
+
+    span runs up to the matching close brace if the object is balanced, otherwise to the
+    end of the text; open_brackets is the stack of still-unclosed brackets (empty if balanced).
+    Brackets inside string literals are ignored. Returns (None, []) if there is no '{'.
+    """
+    start = text.find("{")
+    if start == -1:
+        return None, []
+
+    stack = []
+    in_string = False
+    escaped = False
+    for pos in range(start, len(text)):
+        ch = text[pos]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in _JSON_CLOSERS:
+            stack.append(ch)
+        elif ch in "}]" and stack:
+            stack.pop()
+            if not stack:
+                return text[start:pos + 1], []
+
+    if in_string:
+        stack.append('"')
+    return text[start:], stack
+
+
+def recover_json(text: str) -> tuple:
+    """
+    Parse a model response as JSON, salvaging common near-misses instead of forcing a retry.
+
+    Stages, tried in order: "direct" (trimmed text), "fence" (contents of a ```json block),
+    "balanced" (first balanced {...} span, dropping surrounding prose) and "closed" (a
+    truncated object with its unclosed strings/brackets closed). Returns (data, stage),
+    or (None, None) if no stage produced valid JSON.
+    """
+    text = text.strip()
+    data, ok = _try_json_loads(text)
+    if ok:
+        return data, "direct"
+
+    fence_match = _JSON_FENCE_RE.search(text)
+    if fence_match:
+        text = fence_match.group(1).strip()
+        data, ok = _try_json_loads(text)
+        if ok:
+            return data, "fence"
+
+    span, open_brackets = _scan_json_object(text)
+    if span is None:
+        return None, None
+    if not open_brackets:
+        data, ok = _try_json_loads(span)
+        return (data, "balanced") if ok else (None, None)
+
+    closing = "".join('"' if b == '"' else _JSON_CLOSERS[b] for b in reversed(open_brackets))
+    data, ok = _try_json_loads(span.rstrip().rstrip(",") + closing)
+    return (data, "closed") if ok else (None, None)
+
+
+class ResponseParseError(ValueError):
+    """Raised when a Gemini response carries neither structured output nor recoverable JSON text."""
+
+
+def extract_structured_output(response) -> Any:
+    """
+    Return the review data carried by a Gemini response.
+
+    Sources, tried in order: the first part's function_call.parsed, response.parsed,
+    then the response text via recover_json(). Raises ResponseParseError if none yields data.
+    """
+    candidates = getattr(response, 'candidates', None)
+    if candidates:
+        parts = getattr(getattr(candidates[0], 'content', None), 'parts', None)
+        function_call = getattr(parts[0], 'function_call', None) if parts else None
+        if function_call and hasattr(function_call, 'parsed'):
+            logger.debug("Received structured output response with function_call.parsed attribute.")
+            return function_call.parsed
+
+    if hasattr(response, 'parsed'):
+        logger.debug("Received structured output response with parsed attribute.")
+        return response.parsed
+
+    # Fallback to text parsing if structured output is not available
+    logger.debug("Structured output not available. Falling back to text parsing.")
+    data, parse_stage = recover_json(response.text)
+    if parse_stage is None:
+        raise ResponseParseError("No recoverable JSON object in AI response")
+    JSON_PARSE_STAGE_COUNTS[parse_stage] += 1
+    if parse_stage != "direct":
+        logger.info("Recovered JSON from AI response using the '%s' stage.", parse_stage)
+    return data
+
+
+PROMPT_LOG_SAMPLE_EVERY = 10
+_prompt_log_counter = itertools.count(1)
+
+
+def _freeze(value: Any) -> Any:
+    """Recursively turn dicts into read-only MappingProxyType views and lists into tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value: Any) -> Any:
+    """Inverse of _freeze: plain dicts and lists, for APIs that copy or mutate their arguments."""
+    if isinstance(value, Mapping):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+
+# The constants below are shared by all concurrent calls, so they are frozen against accidental mutation
+
+# Schema for a single review item
+REVIEW_ITEM_SCHEMA = _freeze({
+    "type": "object",
+    "properties": {
+        "fileIndex": {"type": "integer", "description": "0-based index of the file (multi-file prompts only)"},
+        "hunkIndex": {"type": "integer", "description": "0-based index of the hunk in the diff"},
+        "lineNumber": {"type": "integer", "description": "1-based line number within the hunk content"},
+        "reviewComment": {"type": "string", "description": "The review comment text in GitHub Markdown format"},
+        "confidence": {"type": "string", "enum": ["High", "Medium", "Low"], "description": "Confidence level of the review comment"}
+    },
+    "required": ["hunkIndex", "lineNumber", "reviewComment", "confidence"]
+})
+
+# Overall response schema
+REVIEW_RESPONSE_SCHEMA = _freeze({
+    "type": "object",
+    "properties": {
+        "reviews": {
+            "type": "array",
+            "items": REVIEW_ITEM_SCHEMA,
+            "description": "Array of review comments for the PR"
+        }
+    },
+    "required": ["reviews"]
+})
+
+# Validation rules for process_structured_output, derived from the schema so the two can't drift apart
+REVIEW_REQUIRED_KEYS = frozenset(REVIEW_ITEM_SCHEMA["required"])
+REVIEW_INTEGER_KEYS = tuple(key for key, prop in REVIEW_ITEM_SCHEMA["properties"].items() if prop["type"] == "integer")
+REVIEW_CONFIDENCE_VALUES = frozenset(REVIEW_ITEM_SCHEMA["properties"]["confidence"]["enum"])
+
+GEMINI_GENERATION_CONFIG = _freeze({
+    "max_output_tokens": GEMINI_MAX_OUTPUT_TOKENS,
+    "temperature": 0.4,
+    "top_p": 0.95,
+    "top_k": 40,
+    "response_mime_type": "application/json",  # Enable structured output
+    "response_schema": REVIEW_RESPONSE_SCHEMA  # Define the expected response structure
+})
+
+GEMINI_SAFETY_SETTINGS = _freeze([
+    {"category": f"HARM_CATEGORY_{category}", "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
+    for category in ("HARASSMENT", "HATE_SPEECH", "SEXUALLY_EXPLICIT", "DANGEROUS_CONTENT")
+])
+
+# One GenerativeModel per (api_key, model_name); models are reused across files and retry attempts
+_MODEL_CACHE: Dict[tuple, Any] = {}
+
+
+# Finish reasons that are a deterministic outcome of the prompt rather than a transient failure
+TERMINAL_FINISH_REASONS = frozenset({"SAFETY", "RECITATION", "MAX_TOKENS", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII"})
+
+
+def get_terminal_finish_reason(response) -> Optional[str]:
+    """Return why an empty response will not change on retry (blocked prompt or terminal finish reason), else None."""
+    # BLOCK_REASON_UNSPECIFIED is 0, so only a real block reason is truthy
+    block_reason = getattr(getattr(response, 'prompt_feedback', None), 'block_reason', None)
+    if block_reason:
+        return f"prompt blocked: {getattr(block_reason, 'name', block_reason)}"
+    candidates = getattr(response, 'candidates', None)
+    if candidates:
+        finish_reason = getattr(candidates[0], 'finish_reason', None)
+        finish_reason_name = getattr(finish_reason, 'name', str(finish_reason))
+        if finish_reason_name in TERMINAL_FINISH_REASONS:
+            return f"finish reason: {finish_reason_name}"
+    return None
+
+
+def get_gemini_model(api_key: str, model_name: str):
+    """Return the cached GenerativeModel for this key and model, creating it on first use."""
+    gemini_model = _MODEL_CACHE.get((api_key, model_name))
+    if gemini_model is None:
+        gemini_model = _MODEL_CACHE.setdefault((api_key, model_name), gemini_client_module.GenerativeModel(
+            model_name,
+            # The SDK copies and converts these, which read-only mappings don't support
+            generation_config=_thaw(GEMINI_GENERATION_CONFIG),
+            safety_settings=_thaw(GEMINI_SAFETY_SETTINGS)
+        ))
+    return gemini_model
 
 
-def get_ai_response_with_structured_output(prompt: str, model_name: str, max_retries: int = 3) -> List[Dict[str, Any]]:
+async def get_ai_response_with_structured_output(prompt: str, model_name: str, max_retries: int = 10) -> Optional[List[Dict[str, Any]]]:
     """
     Get AI response with improved structured output handling.
 
     This function uses Gemini's structured output feature with proper error handling
     and fallback mechanisms. It also handles rate limiting by rotating API keys.
+    Returns None when no usable response could be obtained, as opposed to [] for "no issues found".
+    A response that was blocked or cut off for a deterministic reason also returns [], since
+    resending the prompt (alone or split by file) would get the same result. If the final attempt
+    still got a response without recoverable JSON, ResponseParseError is raised instead, so batched
+    callers can retry with smaller prompts.
     """
     global gemini_key_manager
 
     if not gemini_client_module:
-        print("Error: Gemini client module not initialized. Cannot make API call.")
+        logger.error("Gemini client module not initialized. Cannot make API call.")
         return []
 
     if not gemini_key_manager:
-        print("Error: Gemini key manager not initialized. Cannot make API call.")
+        logger.error("Gemini key manager not initialized. Cannot make API call.")
         return []
 
-    # Define the schema for review items
-    review_item_schema = {
-        "type": "object",
-        "properties": {
-            "hunkIndex": {"type": "integer", "description": "0-based index of the hunk in the diff"},
-            "lineNumber": {"type": "integer", "description": "1-based line number within the hunk content"},
-            "reviewComment": {"type": "string", "description": "The review comment text in GitHub Markdown format"},
-            "confidence": {"type": "string", "enum": ["High", "Medium", "Low"], "description": "Confidence level of the review comment"}
-        },
-        "required": ["hunkIndex", "lineNumber", "reviewComment", "confidence"]
-    }
-
-    # Define the overall response schema
-    response_schema = {
-        "type": "object",
-        "properties": {
-            "reviews": {
-                "type": "array",
-                "items": review_item_schema,
-                "description": "Array of review comments for the PR"
-            }
-        },
-        "required": ["reviews"]
-    }
+    # Prompts can be 100KB+: log them in full only at DEBUG, and sample a short excerpt at INFO
+    prompt_log_n = next(_prompt_log_counter)
+    log_sampled = prompt_log_n % PROMPT_LOG_SAMPLE_EVERY == 1
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Full prompt #%d (length %d). Start:\n%s...\n...End:\n%s", prompt_log_n, len(prompt), prompt[:1000], prompt[-1000:])
+    elif log_sampled:
+        logger.info("Prompt #%d (length %d, 1 in %d logged). Start:\n%s...", prompt_log_n, len(prompt), PROMPT_LOG_SAMPLE_EVERY, prompt[:500])
 
-    # Log the prompt length
-    print(f"Full prompt (length {len(prompt)}). Start:\n{prompt[:1000]}...\n...End:\n{prompt[-1000:]}")
+    estimated_tokens = estimate_prompt_tokens(prompt)
 
     for attempt in range(1, max_retries + 1):
         try:
-            # Create the model with structured output configuration and current API key
-            # We recreate the model on each attempt to ensure we're using the current API key
-            Client.configure(api_key=gemini_key_manager.get_current_key())
-
-            gemini_model = gemini_client_module.GenerativeModel(
-                model_name,
-                generation_config={
-                    "max_output_tokens": 8192,
-                    "temperature": 0.4,
-                    "top_p": 0.95,
-                    "top_k": 40,
-                    "response_mime_type": "application/json",  # Enable structured output
-                    "response_schema": response_schema  # Define the expected response structure
-                },
-                safety_settings=[
-                    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                ]
-            )
-
-            enforce_gemini_rate_limits()
-            # Only show first 5 chars of key followed by *** for security
-            # Ensure get_current_key() returns a string before slicing
-            current_key_value = gemini_key_manager.get_current_key()
-            key_prefix = current_key_value[:5] if current_key_value else "None"
-            print(f"Attempt {attempt}/{max_retries} - Sending prompt to Gemini model {model_name} with structured output using key: {key_prefix}***")
-
-            # Generate content with the prompt
-            response = gemini_model.generate_content(prompt)
-
-            if not response.parts:
-                print(f"Warning: AI response (attempt {attempt}) was empty or blocked.")
+            # Wait for the key's rate-limit budget before touching the SDK. A model binds to the globally
+            # configured key on its first call, so configuring the key and starting the call must not be
+            # separated by an await: a concurrent rotation could reconfigure the SDK in between and bind
+            # the model cached for this key to another one for the rest of the run.
+            current_key_name = gemini_key_manager.get_current_key_name()
+            await enforce_gemini_rate_limits(estimated_tokens, current_key_name)
+            while (rotated_key_name := gemini_key_manager.get_current_key_name()) != current_key_name:
+                # Another call rotated the key while this one waited; take budget from the new key instead
+                current_key_name = rotated_key_name
+                await enforce_gemini_rate_limits(estimated_tokens, current_key_name)
+            current_key_value = gemini_key_manager.get_key_by_name(current_key_name)
+            configure_gemini_key(current_key_value)
+            gemini_model = get_gemini_model(current_key_value, model_name)
+
+            # Retries are always worth seeing; first attempts are sampled like the prompt log
+            log_level = logging.INFO if attempt > 1 or log_sampled else logging.DEBUG
+            if logger.isEnabledFor(log_level):
+                # Only show first 5 chars of key followed by *** for security
+                key_prefix = current_key_value[:5] if current_key_value else "None"
+                logger.log(log_level, "Attempt %d/%d - Sending prompt #%d to Gemini model %s with structured output using key: %s***",
+                           attempt, max_retries, prompt_log_n, model_name, key_prefix)
+
+            # Generate content with the prompt. The SDK binds a new model's client before its first await,
+            # so no other call can reconfigure the key between configure_gemini_key() and here.
+            response = await gemini_model.generate_content_async(prompt)
+
+            # response.parts raises ValueError when there are no candidates, which is how a blocked
+            # prompt comes back, so check the candidates first
+            if not response.candidates or not response.parts:
+                terminal_reason = get_terminal_finish_reason(response)
+                if terminal_reason:
+                    # Resending the same prompt would be blocked or truncated the same way
+                    logger.warning("AI response was empty (%s). Not retrying.", terminal_reason)
+                    return []
+                logger.warning("AI response (attempt %d) was empty or blocked.", attempt)
                 if attempt < max_retries:
-                    time.sleep((2 ** attempt) * 2)
+                    await asyncio.sleep(jittered((2 ** attempt) * 2))
                     continue
-                return []
-
-            # Check if we have a structured output response
-            if hasattr(response, 'candidates') and response.candidates:
-                candidate = response.candidates[0]
-                if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
-                    part = candidate.content.parts[0]
-                    if hasattr(part, 'function_call') and part.function_call and hasattr(part.function_call, 'parsed'):
-                        print("Received structured output response with function_call.parsed attribute.")
-                        data = part.function_call.parsed
-                        # Process the structured output
-                        return process_structured_output(data)
-
-            # Check if we have a parsed response (structured output)
-            if hasattr(response, 'parsed'):
-                print("Received structured output response with parsed attribute.")
-                data = response.parsed
-                # Process the structured output
-                return process_structured_output(data)
-
-            # Fallback to text parsing if structured output is not available
-            print("Structured output not available. Falling back to text parsing.")
-            response_text = response.text.strip()
-
-            # Clean up the response text if it's wrapped in markdown code blocks
-            if response_text.startswith("```json"):
-                response_text = response_text[len("```json"):]
-            if response_text.endswith("```"):
-                response_text = response_text[:-len("```")]
-            response_text = response_text.strip()
-
-            # Parse the JSON
-            data = json.loads(response_text)
-
-            # Process the parsed JSON
-            return process_structured_output(data)
-
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON from AI response (attempt {attempt}): {e}")
+                return None
+
+            return process_structured_output(extract_structured_output(response))
+
+        except ResponseParseError as e:
+            logger.error("Error decoding JSON from AI response (attempt %d): %s", attempt, e)
             if attempt < max_retries:
-                time.sleep(2 ** attempt)
+                await asyncio.sleep(jittered(2 ** attempt))
                 continue
-            return []
+            raise
         except Exception as e:
-            print(f"Error during Gemini API call (attempt {attempt}): {type(e).__name__} - {e}")
+            logger.error("Error during Gemini API call (attempt %d): %s - %s", attempt, type(e).__name__, e)
 
             # Check if this is a rate limit error
             if gemini_key_manager.is_rate_limit_error(e):
-                print(f"Detected rate limit error: {e}")
+                logger.warning("Detected rate limit error: %s", e)
+                gemini_concurrency.record_rate_limited()
 
                 # Log available keys status (without exposing full keys)
                 # Log available keys status (without exposing full keys)
-                key_status_info = []
-                if gemini_key_manager.primary_key:
-                    key_status_info.append(f"GEMINI_API_KEY: {'SET' if gemini_key_manager.primary_key else 'NOT SET'}")
-                if gemini_key_manager.fallback_key:
-                    key_status_info.append(f"GEMINI_FALLBACK_API_KEY: {'SET' if gemini_key_manager.fallback_key else 'NOT SET'}")
+                key_status_info = [f"{key_name}: SET" for key_name in gemini_key_manager.rotation_order]
 
-                print(f"API key status - {', '.join(key_status_info)}")
-                print(f"Currently using: {gemini_key_manager.get_current_key_name()}")
+                logger.info("API key status - %s", ", ".join(key_status_info))
+                logger.info("Currently using: %s", gemini_key_manager.get_current_key_name())
 
                 # Try to rotate to the next available key
-                if gemini_key_manager.rotate_key():
+                if gemini_key_manager.rotate_key(current_key_name):
                     # Only show first 5 chars of key followed by *** for security
                     # Ensure get_current_key() returns a string before slicing
                     current_key_value = gemini_key_manager.get_current_key()
                     key_prefix = current_key_value[:5] if current_key_value else "None"
-                    print(f"Rotated to alternative API key {gemini_key_manager.get_current_key_name()}: {key_prefix}***")
-                    # Don't increment attempt counter when we rotate keys
+                    logger.info("Rotated to alternative API key %s: %s***", gemini_key_manager.get_current_key_name(), key_prefix)
+                    # Retry immediately on the new key. The rotation still uses up this attempt, so
+                    # max_retries bounds the total number of calls, rotations included.
                     continue
                 else:
-                    print("All API keys are rate limited or unavailable")
+                    logger.warning("All API keys are rate limited or unavailable")
 
             # For non-rate-limit errors or if key rotation failed, continue with normal retry logic
             if attempt < max_retries:
-                time.sleep(5 * attempt)
+                delay = get_backoff_delay(attempt, e)
+                logger.info("Retrying in %.1f seconds.", delay)
+                await asyncio.sleep(delay)
                 continue
-            return []
+            return None
 
-    return []
+    return None
 
 
-def get_ai_response_with_retry(prompt: str, max_retries: int = 3) -> List[Dict[str, Any]]:
+async def get_ai_response_with_retry(prompt: str, max_retries: int = 10) -> Optional[List[Dict[str, Any]]]:
     """
     Get AI response with structured output and retry mechanism.
 
@@ -1108,48 +1758,211 @@ def get_ai_response_with_retry(prompt: str, max_retries: int = 3) -> List[Dict[s
 
     The structured output approach constrains the model to generate JSON that matches our schema,
     which should improve reliability and reduce parsing errors.
+    Raises ResponseParseError if the model's output still couldn't be parsed after all retries.
     """
     model_name = os.environ.get('GEMINI_MODEL', 'gemini-1.5-flash-latest')
 
     if not gemini_client_module:
-        print("Error: Gemini client module not initialized. Cannot make API call.")
+        logger.error("Gemini client module not initialized. Cannot make API call.")
         return []
 
     # Use the improved structured output handling function
-    print("Using improved structured output handling function")
-    enforce_gemini_rate_limits()
-    return get_ai_response_with_structured_output(prompt, model_name, max_retries)
+    logger.debug("Using improved structured output handling function")
+    ai_reviews = await get_ai_response_with_structured_output(prompt, model_name, max_retries)
+    if ai_reviews is not None:
+        gemini_concurrency.record_success()
+    return ai_reviews
+
+
+MAX_PROMPT_BUILD_WORKERS = 8
+
+
+MAX_PARALLEL_FILE_REVIEWS = int(os.environ.get("MAX_PARALLEL_FILE_REVIEWS", 4))
+# Files are reviewed several to a Gemini call so the instructions and PR context are sent once per batch
+MAX_BATCH_TOKENS = 200_000
+MAX_FILES_PER_BATCH = int(os.environ.get("MAX_FILES_PER_BATCH", 10))
+# Starts at MAX_PARALLEL_FILE_REVIEWS and adapts to rate limit feedback from Gemini
+gemini_concurrency = AdaptiveConcurrencyLimiter(MAX_PARALLEL_FILE_REVIEWS, ceiling=MAX_PARALLEL_FILE_REVIEWS * 2)
+
+
+async def review_file_async(patched_file: PatchedFile, file_section: str, has_file_context: bool,
+                            review_context: ReviewContext, limiter: AdaptiveConcurrencyLimiter) -> List[Dict[str, Any]]:
+    """Send one file's prompt to Gemini and turn the response into GitHub review comments."""
+    async with limiter:
+        prompt = build_single_file_prompt(review_context, file_section)
+        file_index = _index_file(patched_file)
+        logger.info("Processing file: %s with %d hunks.", patched_file.path, len(file_index[0]))
+
+        # Rather than stall on the TPM budget, drop the full file context and send just the diff
+        if has_file_context and \
+                get_rate_limit_buckets()[1].wait_time(estimate_prompt_tokens(prompt)) > GEMINI_TPM_PERMIT_TIMEOUT_SECONDS:
+            logger.info("TPM budget is low; sending %s without full file context.", patched_file.path)
+            prompt = create_batch_prompt(patched_file, review_context, "")
+
+        try:
+            ai_reviews_for_file = await get_ai_response_with_retry(prompt)
+        except ResponseParseError:
+            logger.warning("Gemini's response for %s could not be parsed after all retries.", patched_file.path)
+            ai_reviews_for_file = None
+
+    if not ai_reviews_for_file:
+        logger.info("No review suggestions from AI for file %s.", patched_file.path)
+        return []
+
+    logger.info("Received %d review suggestions from AI for file %s.", len(ai_reviews_for_file), patched_file.path)
+    return process_batch_ai_reviews(patched_file, ai_reviews_for_file, file_index)
+
+
+def split_reviews_by_file(ai_reviews: List[Dict[str, Any]], num_files: int) -> Optional[List[List[Dict[str, Any]]]]:
+    """Demultiplex a multi-file response by fileIndex. Returns None if any item has an unusable fileIndex."""
+    reviews_by_file = [[] for _ in range(num_files)]
+    for review_item in ai_reviews:
+        file_idx = review_item.get("fileIndex")
+        if not isinstance(file_idx, int) or not (0 <= file_idx < num_files):
+            logger.warning("Multi-file review item has missing or out-of-range fileIndex %r.", file_idx)
+            return None
+        reviews_by_file[file_idx].append(review_item)
+    return reviews_by_file
+
+
+async def review_batch_async(batch: List[int], files_to_analyze: List[PatchedFile], file_sections: Dict[int, str],
+                             file_contents: Dict[str, str], review_context: ReviewContext,
+                             limiter: AdaptiveConcurrencyLimiter) -> List[Dict[str, Any]]:
+    """
+    Review a batch of files with a single Gemini call.
+
+    Falls back to one call per file only when the TPM budget is too short for the batch prompt,
+    or the response couldn't be parsed or mapped back to files. A batch whose retries ran out
+    for any other reason (e.g. every key rate limited) is not retried file by file, which would
+    only multiply the calls against an exhausted quota.
+    """
+    async def review_individually():
+        results = await asyncio.gather(*(
+            review_file_async(files_to_analyze[i], file_sections[i], bool(file_contents[files_to_analyze[i].path]),
+                              review_context, limiter)
+            for i in batch
+        ))
+        return [comment for file_comments in results for comment in file_comments]
+
+    if len(batch) == 1:
+        return await review_individually()
+
+    patched_files = [files_to_analyze[i] for i in batch]
+    async with limiter:
+        prompt = create_multi_file_batch_prompt(patched_files, review_context, [file_sections[i] for i in batch])
+        logger.info("Processing batch of %d files: %s", len(patched_files), ", ".join(pf.path for pf in patched_files))
+        tpm_budget_short = get_rate_limit_buckets()[1].wait_time(estimate_prompt_tokens(prompt)) > GEMINI_TPM_PERMIT_TIMEOUT_SECONDS
+        ai_reviews = None
+        response_unparseable = False
+        if not tpm_budget_short:
+            try:
+                ai_reviews = await get_ai_response_with_retry(prompt)
+            except ResponseParseError:
+                response_unparseable = True
+
+    if tpm_budget_short:
+        # The per-file path knows how to shrink prompts when the TPM budget is short
+        logger.info("TPM budget is low for a batch of %d files; reviewing them individually.", len(patched_files))
+        return await review_individually()
+
+    if response_unparseable:
+        logger.warning("Batched response for %d files could not be parsed; falling back to per-file reviews.", len(patched_files))
+        return await review_individually()
+
+    if ai_reviews is None:
+        logger.warning("No usable response for the batch of %d files after all retries; skipping them.", len(patched_files))
+        return []
+
+    reviews_by_file = split_reviews_by_file(ai_reviews, len(patched_files))
+    if reviews_by_file is None:
+        logger.warning("Batched review for %d files had an unusable fileIndex mapping; falling back to per-file reviews.", len(patched_files))
+        return await review_individually()
+
+    comments = []
+    for patched_file, file_reviews in zip(patched_files, reviews_by_file):
+        if not file_reviews:
+            logger.info("No review suggestions from AI for file %s.", patched_file.path)
+            continue
+        logger.info("Received %d review suggestions from AI for file %s.", len(file_reviews), patched_file.path)
+        comments.extend(process_batch_ai_reviews(patched_file, file_reviews, _index_file(patched_file)))
+    return comments
+
+
+def group_into_batches(file_sections: Dict[int, str]) -> List[List[int]]:
+    """Group consecutive files into batches bounded by MAX_BATCH_TOKENS and MAX_FILES_PER_BATCH."""
+    batches = []
+    current_batch = []
+    current_tokens = 0
+    for i in range(len(file_sections)):
+        prompt_tokens = len(file_sections[i]) // 4
+        if current_batch and (current_tokens + prompt_tokens > MAX_BATCH_TOKENS or len(current_batch) >= MAX_FILES_PER_BATCH):
+            batches.append(current_batch)
+            current_batch = []
+            current_tokens = 0
+        current_batch.append(i)
+        current_tokens += prompt_tokens
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+
+async def review_files_async(files_to_analyze: List[PatchedFile], file_sections: Dict[int, str],
+                             file_contents: Dict[str, str], review_context: ReviewContext) -> List[Dict[str, Any]]:
+    """Review all files concurrently, with in-flight calls bounded by gemini_concurrency, keeping the input order."""
+    batches = group_into_batches(file_sections)
+    results = await asyncio.gather(*(
+        review_batch_async(batch, files_to_analyze, file_sections, file_contents, review_context, gemini_concurrency)
+        for batch in batches
+    ))
+    return [comment for batch_comments in results for comment in batch_comments]
 
 
 def analyze_code(files_to_review: Iterable[PatchedFile], review_context: ReviewContext) -> List[Dict[str, Any]]:
     files_list = list(files_to_review)
-    print(f"Starting code analysis for {len(files_list)} files.")
-    all_comments_for_pr = []
+    logger.info("Starting code analysis for %d files.", len(files_list))
 
+    files_to_analyze = []
     for patched_file in files_list:
         if not patched_file.path or patched_file.path == "/dev/null":
-            print(f"Skipping file with invalid path: {patched_file.path}")
+            logger.info("Skipping file with invalid path: %s", patched_file.path)
             continue
 
-        hunks_in_file = list(patched_file)
-        if not hunks_in_file:
-            print(f"No hunks in file {patched_file.path}, skipping.")
+        if not patched_file:
+            logger.info("No hunks in file %s, skipping.", patched_file.path)
             continue
 
-        print(f"\nProcessing file: {patched_file.path} with {len(hunks_in_file)} hunks.")
-
-        batch_prompt = create_batch_prompt(patched_file, review_context)
-        ai_reviews_for_file = get_ai_response_with_retry(batch_prompt)
+        files_to_analyze.append(patched_file)
+
+    # Prompt construction is dominated by file reads: read every unique path concurrently up front,
+    # then build each file's review section once from the prefetched contents. Batch and per-file
+    # prompts are both assembled from these sections when they are sent.
+    file_sections = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PROMPT_BUILD_WORKERS) as executor:
+        files_by_path = {}
+        for patched_file in files_to_analyze:
+            files_by_path.setdefault(patched_file.path, patched_file)
+        # Added files are entirely in the diff, so they aren't read at all
+        context_paths = [path for path, patched_file in files_by_path.items() if not patched_file.is_added_file]
+        file_contents = dict.fromkeys(files_by_path, "")
+        file_contents.update(zip(context_paths, executor.map(get_file_content, context_paths)))
+        for path in context_paths:
+            if diff_covers_most_of_file(files_by_path[path], file_contents[path]):
+                logger.info("Diff already covers most of %s; skipping full file context.", path)
+                file_contents[path] = ""
+
+        future_to_index = {
+            executor.submit(build_file_review_section, patched_file, review_context, file_contents[patched_file.path]): i
+            for i, patched_file in enumerate(files_to_analyze)
+        }
+        for future in concurrent.futures.as_completed(future_to_index):
+            file_sections[future_to_index[future]] = future.result()
 
-        if ai_reviews_for_file:
-            print(f"Received {len(ai_reviews_for_file)} review suggestions from AI for file {patched_file.path}.")
-            file_comments = process_batch_ai_reviews(patched_file, ai_reviews_for_file)
-            if file_comments:
-                all_comments_for_pr.extend(file_comments)
-        else:
-            print(f"No review suggestions from AI for file {patched_file.path}.")
+    # Gemini calls are network-bound: run them concurrently on one event loop
+    all_comments_for_pr = asyncio.run(
+        review_files_async(files_to_analyze, file_sections, file_contents, review_context)
+    )
 
-    print(f"\nFinished analysis. Total comments generated for PR: {len(all_comments_for_pr)}")
+    logger.info("Finished analysis. Total comments generated for PR: %d", len(all_comments_for_pr))
     return all_comments_for_pr
 
 
@@ -1163,9 +1976,10 @@ def get_hunk_header_str(hunk: Hunk) -> str:
 # Function removed as it's redundant - process_batch_ai_reviews will call improved_calculate_github_position directly
 
 
-def process_batch_ai_reviews(patched_file: PatchedFile, ai_reviews: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def process_batch_ai_reviews(patched_file: PatchedFile, ai_reviews: List[Dict[str, Any]],
+                             file_index: Optional[tuple] = None) -> List[Dict[str, Any]]:
     comments_for_github = []
-    hunks_in_file = list(patched_file)
+    hunks_in_file, hunk_lens, prefix = file_index if file_index is not None else _index_file(patched_file)
 
     for review_detail in ai_reviews:
         try:
@@ -1175,66 +1989,56 @@ def process_batch_ai_reviews(patched_file: PatchedFile, ai_reviews: List[Dict[st
             confidence = review_detail["confidence"]
 
             if not (0 <= hunk_idx_from_ai < len(hunks_in_file)):
-                print(f"Warning: AI returned out-of-bounds hunkIndex {hunk_idx_from_ai} for file {patched_file.path} "
-                      f"(has {len(hunks_in_file)} hunks). Skipping comment.")
+                logger.warning("AI returned out-of-bounds hunkIndex %s for file %s (has %d hunks). Skipping comment.",
+                               hunk_idx_from_ai, patched_file.path, len(hunks_in_file))
                 continue
 
             # Call improved_calculate_github_position directly with the hunk index
-            github_pos_result = improved_calculate_github_position(patched_file, hunk_idx_from_ai, line_num_in_hunk_content)
+            github_pos_result = improved_calculate_github_position(prefix, hunk_lens, hunk_idx_from_ai, line_num_in_hunk_content)
 
             if github_pos_result is None:
-                print(f"Warning: Could not calculate GitHub position for comment in {patched_file.path}, "
-                      f"Hunk Index {hunk_idx_from_ai}, Line {line_num_in_hunk_content}. Skipping.")
+                logger.warning("Could not calculate GitHub position for comment in %s, Hunk Index %s, Line %s. Skipping.",
+                               patched_file.path, hunk_idx_from_ai, line_num_in_hunk_content)
                 continue
 
             formatted_comment_body = f"**My Confidence: {confidence}**\n\n{comment_text}"
 
-            # If github_pos_result is None, it means the position couldn't be calculated precisely
-            if github_pos_result is None:
-                # For invalid positions, we'll add a special prefix to the comment
-                formatted_comment_body = (
-                    "**Note: I couldn't precisely position this comment in the diff, but I think it's important feedback:**\n\n"
-                    f"**My Confidence: {confidence}**\n\n{comment_text}"
-                )
-                # Add the comment to the list of comments to post at the file level (position=1)
-                gh_comment = {
-                    "body": formatted_comment_body,
-                    "path": patched_file.path,
-                    "position": 1,  # File-level comment
-                    "confidence_raw": confidence,
-                    "invalidPosition": True  # Add flag for tracking
-                }
-            else:
-                # Normal case with valid position
-                gh_comment = {
-                    "body": formatted_comment_body,
-                    "path": patched_file.path,
-                    "position": github_pos_result,
-                    "confidence_raw": confidence
-                }
+            gh_comment = {
+                "body": formatted_comment_body,
+                "path": patched_file.path,
+                "position": github_pos_result,
+                "confidence_raw": confidence
+            }
+
+            # Classified once here; save_review_results_to_json and the summary reuse these
+            gh_comment["severity_heuristic"], gh_comment["category_heuristic"] = classify_comment(formatted_comment_body)
 
             comments_for_github.append(gh_comment)
 
         except KeyError as e:
-            print(f"Error processing AI review item due to missing key {e}: {review_detail}")
+            logger.error("Error processing AI review item due to missing key %s: %s", e, review_detail)
         except Exception as e:
-            print(f"Unexpected error processing AI review item {review_detail}: {e}")
-            traceback.print_exc()
+            logger.exception("Unexpected error processing AI review item %s: %s", review_detail, e)
 
     return comments_for_github
 
 
+@functools.lru_cache(maxsize=None)
+def ensure_directory(directory: str) -> None:
+    """Create `directory` (and parents) if needed; the mkdir runs at most once per directory per process."""
+    os.makedirs(directory, exist_ok=True)
+
+
 def save_review_results_to_json(review_context: ReviewContext, comments: List[Dict[str, Any]], filepath_str: str = "reviews/gemini-pr-review.json") -> str:
     filepath = Path(filepath_str)
-    filepath.parent.mkdir(parents=True, exist_ok=True)
+    ensure_directory(str(filepath.parent))
 
     # Get API key info for metadata
     api_key_info = "primary"
     rate_limited = False # Default to False
 
     if gemini_key_manager:
-        if gemini_key_manager.current_key_name == "GEMINI_FALLBACK_API_KEY":
-            api_key_info = "fallback (rotated due to rate limiting)"
+        api_key_info = gemini_key_manager.describe_current_key()
         # Check if ALL keys were rate limited (for commit message)
         rate_limited = gemini_key_manager.all_keys_rate_limited
 
@@ -1257,32 +2061,126 @@ def save_review_results_to_json(review_context: ReviewContext, comments: List[Di
         review_data["metadata"]["commit_sha"] = review_context.commit_sha
 
     for gh_comment_dict in comments:
+        severity, category = get_comment_classification(gh_comment_dict)
         structured_comment = {
             "file_path": gh_comment_dict["path"],
             "github_diff_position": gh_comment_dict["position"],
             "comment_text_md": gh_comment_dict["body"],
             "ai_confidence": gh_comment_dict.get("confidence_raw", "N/A"),
-            "detected_severity_heuristic": detect_severity(gh_comment_dict["body"]),
-            "detected_category_heuristic": detect_category(gh_comment_dict["body"])
+            "detected_severity_heuristic": severity,
+            "detected_category_heuristic": category
         }
 
-        # Include invalidPosition flag if present
-        if gh_comment_dict.get("invalidPosition"):
-            structured_comment["invalidPosition"] = True
-
         review_data["review_comments"].append(structured_comment)
 
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(review_data, f, indent=2)
+    filepath.write_bytes(_json_dumps_indented(review_data))
 
-    print(f"Review results saved to {filepath}")
+    logger.info("Review results saved to %s", filepath)
     return str(filepath)
 
 
+# Keyword buckets for the severity/category heuristics, in priority order (first matching bucket wins)
+SEVERITY_KEYWORDS = (
+    ("critical", (
+        "critical", "security vulnerability", "crash", "exploit", "must fix",
+        "data loss", "deadlock", "race condition", "memory leak", "infinite loop",
+    )),
+    ("high", (
+        "bug", "error", "incorrect", "wrong", "security", "potential vulnerability",
+        "flaw", "exception", "broken", "incorrect behavior", "inconsistent behavior",
+    )),
+    ("medium", (
+        "performance", "optimization", "memory", "leak", "consider fixing",
+        "confusing", "unclear", "inefficient", "redundant", "duplicate",
+    )),
+    ("low", (
+        "style", "formatting", "naming", "convention", "documentation",
+        "comment", "clarity", "suggestion", "consider", "might", "could",
+    )),
+)
+
+CATEGORY_KEYWORDS = (
+    ("security", (
+        "security", "vulnerability", "exploit", "auth", "csrf", "xss",
+        "injection", "password", "secret", "encryption", "authentication",
+    )),
+    ("concurrency", (
+        "race condition", "deadlock", "concurrency", "thread safety",
+        "synchronization", "atomic", "lock", "mutex", "semaphore",
+    )),
+    ("bug", (
+        "bug", "error", "incorrect", "wrong", "fix", "defect", "exception",
+        "nullpointer", "undefined", "crash", "broken", "inconsistent behavior",
+    )),
+    ("resource-management", (
+        "memory leak", "resource leak", "file handle", "connection",
+        "not closed", "not released", "not disposed",
+    )),
+    ("performance", (
+        "performance", "slow", "optimization", "efficient", "memory",
+        "cpu", "latency", "resource", "bottleneck", "timeout", "delay",
+    )),
+    ("error-handling", (
+        "error handling", "exception handling", "try/catch", "recovery",
+        "fallback", "resilience", "robustness",
+    )),
+    ("refactoring/design", (
+        "refactor", "clean", "simplify", "maintainability", "design", "architecture",
+        "pattern", "anti-pattern", "duplication", "redundant", "duplicate",
+    )),
+    ("state-management", (
+        "state management", "state machine", "lifecycle", "initialization",
+        "cleanup", "side effect",
+    )),
+    ("testing", (
+        "test", "coverage", "assertion", "mocking", "unit test",
+        "integration test", "e2e test",
+    )),
+    ("style/clarity", (
+        "style", "format", "naming", "convention", "readability", "clarity",
+        "understandability", "documentation", "commenting",
+    )),
+)
+
+
+def _build_keyword_matcher(keyword_tables: Dict[str, tuple]):
+    """
+    Compile every heuristic keyword into one regex so a comment is scanned once.
+
+    The pattern is a lookahead alternation (longest keywords first), so finditer()
+    reports the longest keyword starting at each offset. Each keyword maps to the
+    buckets of every keyword it contains, which accounts for shorter keywords
+    sharing that offset (e.g. "error" inside "error handling").
+    """
+    keyword_buckets = defaultdict(set)
+    for kind, table in keyword_tables.items():
+        for label, keywords in table:
+            for keyword in keywords:
+                keyword_buckets[keyword].add((kind, label))
+
+    keyword_to_hits = {
+        keyword: frozenset().union(*(buckets for other, buckets in keyword_buckets.items() if other in keyword))
+        for keyword in keyword_buckets
+    }
+    alternation = "|".join(re.escape(k) for k in sorted(keyword_to_hits, key=len, reverse=True))
+    return re.compile(f"(?=({alternation}))"), keyword_to_hits
+
+
+_KEYWORD_RE, _KEYWORD_HITS = _build_keyword_matcher({"severity": SEVERITY_KEYWORDS, "category": CATEGORY_KEYWORDS})
+
+
+def _keyword_hits(lower_text: str) -> frozenset:
+    """Return the set of (kind, label) buckets whose keywords occur in lower_text."""
+    return frozenset().union(*(_KEYWORD_HITS[m.group(1)] for m in _KEYWORD_RE.finditer(lower_text)))
+
+
 def detect_severity(comment_text: str) -> str:
     """Heuristically detect the severity of a comment based on its content and confidence level."""
     lower_text = comment_text.lower()
+    return _severity_from_hits(lower_text, _keyword_hits(lower_text))
+
 
+def _severity_from_hits(lower_text: str, hits: frozenset) -> str:
     # Extract confidence level if present
     confidence = "medium"  # Default
     if "**ai confidence: high**" in lower_text:
@@ -1292,35 +2190,23 @@ def detect_severity(comment_text: str) -> str:
     elif "**ai confidence: low**" in lower_text:
         confidence = "low"
 
-    # Check for critical severity indicators - highest priority runtime issues
-    if any(word in lower_text for word in [
-        "critical", "security vulnerability", "crash", "exploit", "must fix",
-        "data loss", "deadlock", "race condition", "memory leak", "infinite loop"
-    ]):
+    # Critical severity indicators - highest priority runtime issues
+    if ("severity", "critical") in hits:
         return "critical"
 
-    # Check for high severity indicators - focus on runtime issues
-    if any(word in lower_text for word in [
-        "bug", "error", "incorrect", "wrong", "security", "potential vulnerability",
-        "flaw", "exception", "broken", "incorrect behavior", "inconsistent behavior"
-    ]):
+    # High severity indicators - focus on runtime issues
+    if ("severity", "high") in hits:
         return "high"
 
-    # Check for medium severity indicators - focus on code quality and maintainability
-    if any(word in lower_text for word in [
-        "performance", "optimization", "memory", "leak", "consider fixing",
-        "confusing", "unclear", "inefficient", "redundant", "duplicate"
-    ]):
+    # Medium severity indicators - focus on code quality and maintainability
+    if ("severity", "medium") in hits:
         # Upgrade to high if confidence is high
         if confidence == "high":
             return "high"
         return "medium"
 
-    # Check for low severity indicators - minor improvements
-    if any(word in lower_text for word in [
-        "style", "formatting", "naming", "convention", "documentation",
-        "comment", "clarity", "suggestion", "consider", "might", "could"
-    ]):
+    # Low severity indicators - minor improvements
+    if ("severity", "low") in hits:
         # Upgrade based on confidence
         if confidence == "high":
             return "medium"
@@ -1337,74 +2223,43 @@ def detect_severity(comment_text: str) -> str:
 
 def detect_category(comment_text: str) -> str:
     """Categorize review comments based on their content with improved focus on runtime issues."""
-    lower_text = comment_text.lower()
+    return _category_from_hits(_keyword_hits(comment_text.lower()))
 
-    # Runtime behavior categories - highest priority
-    if any(word in lower_text for word in [
-        "security", "vulnerability", "exploit", "auth", "csrf", "xss",
-        "injection", "password", "secret", "encryption", "authentication"
-    ]):
-        return "security"
 
-    if any(word in lower_text for word in [
-        "race condition", "deadlock", "concurrency", "thread safety",
-        "synchronization", "atomic", "lock", "mutex", "semaphore"
-    ]):
-        return "concurrency"
+def _category_from_hits(hits: frozenset) -> str:
+    # Buckets are checked in priority order: runtime behavior first, then quality, then style
+    for label, _ in CATEGORY_KEYWORDS:
+        if ("category", label) in hits:
+            return label
 
-    if any(word in lower_text for word in [
-        "bug", "error", "incorrect", "wrong", "fix", "defect", "exception",
-        "nullpointer", "undefined", "crash", "broken", "inconsistent behavior"
-    ]):
-        return "bug"
+    # Default category
+    return "general"
 
-    if any(word in lower_text for word in [
-        "memory leak", "resource leak", "file handle", "connection",
-        "not closed", "not released", "not disposed"
-    ]):
-        return "resource-management"
 
-    # Performance and optimization
-    if any(word in lower_text for word in [
-        "performance", "slow", "optimization", "efficient", "memory",
-        "cpu", "latency", "resource", "bottleneck", "timeout", "delay"
-    ]):
-        return "performance"
+def classify_comment(comment_text: str) -> tuple:
+    """Return (severity, category) for a comment, lowercasing and scanning its text only once."""
+    lower_text = comment_text.lower()
+    hits = _keyword_hits(lower_text)
+    return _severity_from_hits(lower_text, hits), _category_from_hits(hits)
 
-    # Code quality categories
-    if any(word in lower_text for word in [
-        "error handling", "exception handling", "try/catch", "recovery",
-        "fallback", "resilience", "robustness"
-    ]):
-        return "error-handling"
 
-    if any(word in lower_text for word in [
-        "refactor", "clean", "simplify", "maintainability", "design", "architecture",
-        "pattern", "anti-pattern", "duplication", "redundant", "duplicate"
-    ]):
-        return "refactoring/design"
+def get_comment_classification(gh_comment: Dict[str, Any]) -> tuple:
+    """Return (severity, category) cached on a comment by process_batch_ai_reviews, classifying it if missing."""
+    if "severity_heuristic" in gh_comment and "category_heuristic" in gh_comment:
+        return gh_comment["severity_heuristic"], gh_comment["category_heuristic"]
+    return classify_comment(gh_comment["body"])
 
-    if any(word in lower_text for word in [
-        "state management", "state machine", "lifecycle", "initialization",
-        "cleanup", "side effect"
-    ]):
-        return "state-management"
 
-    # Lower priority categories
-    if any(word in lower_text for word in [
-        "test", "coverage", "assertion", "mocking", "unit test",
-        "integration test", "e2e test"
-    ]):
-        return "testing"
+@functools.lru_cache(maxsize=8)
+def _get_bot_pull(github_client, repo_full_name: str, pull_number: int):
+    """Fetch a PR through the given client once; the lazy repo skips the repository lookup."""
+    return github_client.get_repo(repo_full_name, lazy=True).get_pull(pull_number)
 
-    if any(word in lower_text for word in [
-        "style", "format", "naming", "convention", "readability", "clarity",
-        "understandability", "documentation", "commenting"
-    ]):
-        return "style/clarity"
 
-    # Default category
-    return "general"
+@functools.lru_cache(maxsize=8)
+def _get_bot_commit(github_client, repo_full_name: str, commit_sha: str):
+    """Fetch a commit through the given client once; the lazy repo skips the repository lookup."""
+    return github_client.get_repo(repo_full_name, lazy=True).get_commit(commit_sha)
 
 
 def create_review_and_summary_comment(review_context: ReviewContext, comments_for_gh_review: List[Dict[str, Any]], review_json_path: str):
@@ -1422,13 +2277,9 @@ def create_review_and_summary_comment(review_context: ReviewContext, comments_fo
         target_obj = review_context.pr_obj
         logger.info(f"Targeting PR #{review_context.pull_number} for comments.")
     elif review_context.event_type == "push" and review_context.commit_obj:
-        # Ensure repo_obj is not None before calling get_commit
-        if review_context.repo_obj:
-            target_obj = review_context.repo_obj.get_commit(review_context.commit_sha)
-            logger.info(f"Targeting commit {review_context.commit_sha} for comments.")
-        else:
-            logger.error("Repository object not available for push event. Cannot target commit for comments.")
-            return # Exit if repo_obj is None
+        # commit_obj was already fetched for this SHA in get_review_context
+        target_obj = review_context.commit_obj
+        logger.info(f"Targeting commit {review_context.commit_sha} for comments.")
     elif review_context.event_type == "issue_comment" and review_context.pr_obj:
         target_obj = review_context.pr_obj
         logger.info(f"Targeting PR #{review_context.pull_number} for comments (from issue_comment event).")
@@ -1442,31 +2293,25 @@ def create_review_and_summary_comment(review_context: ReviewContext, comments_fo
     # This block is similar to the one above, but for comment posting
     try:
         # First try to use the global gh client which should already be authenticated
-        if gh and hasattr(gh, '_Github__requester') and hasattr(gh._Github__requester, 'auth'):
-            auth_header = getattr(gh._Github__requester.auth, 'token', '')
-            if auth_header and os.environ.get("ZEN_APP_INSTALLATION_ID"):
-                # We're already authenticated with the bot identity
-                if review_context.event_type == "pull_request" and review_context.pr_obj:
-                    repo = gh.get_repo(review_context.get_full_repo_name())
-                    target_obj = repo.get_pull(review_context.pull_number)
-                    logger.info(f"Using globally authenticated client with bot identity for PR #{review_context.pull_number}")
-                elif review_context.event_type == "push" and review_context.commit_obj:
-                    repo = gh.get_repo(review_context.get_full_repo_name())
-                    target_obj = repo.get_commit(review_context.commit_sha)
-                    logger.info(f"Using globally authenticated client with bot identity for commit {review_context.commit_sha}")
+        if gh:
+            if review_context.is_bot_client:
+                # The PR/commit objects were fetched with the bot client already; reuse them as-is
+                logger.info("Using globally authenticated client with bot identity for comments")
             else:
                 logger.info("Global client not authenticated with bot identity, attempting to use bot credentials")
-                review_auth = GitHubAuthenticator()
+                # Reuse the module authenticator and its cached token rather than signing a new JWT
+                review_auth = authenticator or GitHubAuthenticator()
                 github_client, token = review_auth.authenticate()
 
-                if github_client and token:
+                if github_client and token and not review_auth.is_app_authenticated:
+                    # Same GITHUB_TOKEN identity the objects were fetched with; re-fetching gains nothing
+                    logger.warning("Bot identity not available. Using original target object.")
+                elif github_client and token:
                     if review_context.event_type == "pull_request" and review_context.pr_obj:
-                        repo = github_client.get_repo(review_context.get_full_repo_name())
-                        target_obj = repo.get_pull(review_context.pull_number)
+                        target_obj = _get_bot_pull(github_client, review_context.get_full_repo_name(), review_context.pull_number)
                         logger.info(f"Successfully authenticated with bot identity for PR #{review_context.pull_number}")
                     elif review_context.event_type == "push" and review_context.commit_obj:
-                        repo = github_client.get_repo(review_context.get_full_repo_name())
-                        target_obj = repo.get_commit(review_context.commit_sha)
+                        target_obj = _get_bot_commit(github_client, review_context.get_full_repo_name(), review_context.commit_sha)
                         logger.info(f"Successfully authenticated with bot identity for commit {review_context.commit_sha}")
                 else:
                     logger.warning("Bot authentication failed. Using original target object.")
@@ -1476,78 +2321,6 @@ def create_review_and_summary_comment(review_context: ReviewContext, comments_fo
         logger.error(f"Error during GitHub authentication for comments: {auth_error}")
         logger.warning("Falling back to original target object due to error.")
 
-    # Process and post review comments
-    if num_suggestions > 0:
-        valid_review_comments = []
-        for c in comments_for_gh_review:
-            if all(k in c for k in ["body", "path", "position"]):
-                if isinstance(c["position"], int) and isinstance(c["path"], str) and isinstance(c["body"], str):
-                    valid_review_comments.append({
-                        "body": c["body"],
-                        "path": c["path"],
-                        "position": c["position"]
-                    })
-                else:
-                    logger.warning(f"Skipping malformed comment due to type mismatch: {c}")
-            else:
-                logger.warning(f"Skipping malformed comment due to missing keys: {c}")
-
-        if valid_review_comments:
-            if review_context.event_type == "pull_request" and review_context.pr_obj:
-                try:
-                    logger.info(f"Creating a PR review with {len(valid_review_comments)} suggestions.")
-                    target_obj.create_review(
-                        body="I've reviewed your code and have some suggestions:",
-                        event="COMMENT",
-                        comments=valid_review_comments
-                    )
-                    logger.info("Successfully created PR review with suggestions.")
-                except GithubException as e:
-                    logger.error("Error creating PR review: %s (Status: %s, Data: %s)", e, getattr(e, 'status', 'N/A'), getattr(e, 'data', 'N/A'), exc_info=True)
-                    logger.warning("Falling back to posting individual issue comments for suggestions.")
-                    for c_item in valid_review_comments:
-                        try:
-                            # For PRs, issue comments are tied to the PR number
-                            target_obj.create_issue_comment(f"I found an issue in **File:** `{c_item['path']}` (at diff position {c_item['position']})\n\n{c_item['body']}")
-                        except Exception as ie:
-                            logger.error("Error posting individual suggestion as issue comment: %s", ie, exc_info=True)
-                except Exception as e:
-                    logger.error("Unexpected error during PR review creation: %s", e, exc_info=True)
-                    traceback.print_exc()
-            elif review_context.event_type == "push" and review_context.commit_obj:
-                # For push events, comments are posted directly on the commit
-                logger.info(f"Creating {len(valid_review_comments)} comments on commit {review_context.commit_sha}.")
-                for c_item in valid_review_comments:
-                    try:
-                        # Commit comments require path, position, and commit_id
-                        # The 'position' here is the position in the diff, which needs to be calculated
-                        # relative to the target commit.
-                        # For now, we'll simplify and post as general commit comments if direct diff comment is complex.
-                        # GitHub API for commit comments: POST /repos/{owner}/{repo}/commits/{commit_sha}/comments
-                        # This requires `path` and `position` relative to the diff of that commit.
-                        # The `position` from our `improved_calculate_github_position` is for PR diffs.
-                        # For simplicity, we'll post general comments on the commit, or if we want file-specific,
-                        # we can try `create_comment` on the commit object.
-                        # The `position` parameter for `create_comment` on a commit refers to the line number in the *file*,
-                        # not the diff position. This is a key difference.
-                        # For now, let's post as a general comment on the commit, mentioning the file and diff position.
-                        target_obj.create_comment(
-                            body=f"I found an issue in **File:** `{c_item['path']}` (at diff position {c_item['position']})\n\n{c_item['body']}",
-                            path=c_item['path'], # Path relative to the repository root
-                            position=c_item['position'], # Line number in the file (not diff position)
-                            commit_id=review_context.commit_sha
-                        )
-                        logger.info(f"Posted comment on commit {review_context.commit_sha} for file {c_item['path']}.")
-                    except GithubException as e:
-                        logger.error("Error posting commit comment for %s: %s (Status: %s, Data: %s)", c_item['path'], e, getattr(e, 'status', 'N/A'), getattr(e, 'data', 'N/A'), exc_info=True)
-                    except Exception as e:
-                        logger.error("Unexpected error posting commit comment for %s: %s", c_item['path'], e, exc_info=True)
-                        traceback.print_exc()
-            else:
-                logger.warning("No validly structured comments to create a review with.")
-        else:
-            logger.info("No suggestions to create a review for.")
-
     # Prepare summary comment with links to review file
     repo_full_name = os.environ.get("GITHUB_REPOSITORY", review_context.get_full_repo_name())
     server_url = os.environ.get("GITHUB_SERVER_URL", "https://github.com")
@@ -1581,7 +2354,7 @@ def create_review_and_summary_comment(review_context: ReviewContext, comments_fo
         logger.warning("Could not determine branch name for summary comment URL. Link will be generic.")
 
     # Create summary body with categorized findings
-    summary_body = f"✨ **I've completed my code review!** ✨\n\n"
+    summary_parts = [f"✨ **I've completed my code review!** ✨\n\n"]
     if num_suggestions > 0:
         # Group comments by category and severity for better organization
         comments_by_category = {}
@@ -1590,8 +2363,7 @@ def create_review_and_summary_comment(review_context: ReviewContext, comments_fo
                 continue
 
             # Extract category and severity
-            category = detect_category(c["body"])
-            severity = detect_severity(c["body"])
+            severity, category = get_comment_classification(c)
 
             if category not in comments_by_category:
                 comments_by_category[category] = {"high": 0, "medium": 0, "low": 0, "critical": 0}
@@ -1600,10 +2372,10 @@ def create_review_and_summary_comment(review_context: ReviewContext, comments_fo
                 comments_by_category[category][severity] += 1
 
         # Add summary of findings by category
-        summary_body += f"- I found {num_suggestions} potential areas for discussion/improvement (see my review comments above or in the review tab).\n"
-        summary_body += f"- {review_file_url_md}.\n\n"
+        summary_parts.append(f"- I found {num_suggestions} potential areas for discussion/improvement (see my review comments above or in the review tab).\n")
+        summary_parts.append(f"- {review_file_url_md}.\n\n")
 
-        summary_body += "### Summary of My Findings by Category:\n"
+        summary_parts.append("### Summary of My Findings by Category:\n")
         for category, severities in sorted(comments_by_category.items()):
             total = sum(severities.values())
             if total == 0:
@@ -1621,13 +2393,13 @@ def create_review_and_summary_comment(review_context: ReviewContext, comments_fo
                 severity_parts.append(f"{severities['low']} low")
 
             severity_text = ", ".join(severity_parts)
-            summary_body += f"- **{category}**: {total} issues ({severity_text})\n"
+            summary_parts.append(f"- **{category}**: {total} issues ({severity_text})\n")
     else:
-        summary_body += "- I didn't find any specific issues in this code review pass.\n"
+        summary_parts.append("- I didn't find any specific issues in this code review pass.\n")
 
     # Add review information
-    summary_body += f"\n### About My Review\n"
-    summary_body += f"- I used model: `{os.environ.get('GEMINI_MODEL', 'N/A')}`\n"
+    summary_parts.append(f"\n### About My Review\n")
+    summary_parts.append(f"- I used model: `{os.environ.get('GEMINI_MODEL', 'N/A')}`\n")
 
     # Add API key information if key rotation occurred
     api_key_info = "primary"
@@ -1635,9 +2407,8 @@ def create_review_and_summary_comment(review_context: ReviewContext, comments_fo
     fallback_key_note = ""
 
     if gemini_key_manager:
-        if gemini_key_manager.current_key_name == "GEMINI_FALLBACK_API_KEY":
-            api_key_info = "fallback (rotated due to rate limiting)"
-        
+        api_key_info = gemini_key_manager.describe_current_key()
+
         # Add note about fallback key usage if applicable
         if gemini_key_manager.used_fallback_key:
             fallback_key_note = "- **Note:** I encountered rate limiting with the primary API key, but I was able to use the fallback key successfully.\n"
@@ -1646,13 +2417,13 @@ def create_review_and_summary_comment(review_context: ReviewContext, comments_fo
         if gemini_key_manager.all_keys_rate_limited and num_suggestions == 0:
             rate_limit_warning = "\n\n⚠️ **Warning: I encountered rate limiting with ALL my API keys during this review.** My review may be incomplete or missing suggestions due to API quota limitations."
 
-    summary_body += f"- API key used: {api_key_info}\n"
-    summary_body += fallback_key_note
-    summary_body += f"- My review focused on: Logic flaws, runtime behavior issues, and code quality\n"
-    summary_body += f"- To mark my comments as resolved: Add `[ADDRESSED]` to the comment in the JSON file, followed by `**Resolution**: your explanation`\n"
+    summary_parts.append(f"- API key used: {api_key_info}\n")
+    summary_parts.append(fallback_key_note)
+    summary_parts.append(f"- My review focused on: Logic flaws, runtime behavior issues, and code quality\n")
+    summary_parts.append(f"- To mark my comments as resolved: Add `[ADDRESSED]` to the comment in the JSON file, followed by `**Resolution**: your explanation`\n")
 
     # Add rate limit warning if applicable
-    summary_body += rate_limit_warning
+    summary_parts.append(rate_limit_warning)
 
     # Add workflow run log link if available
     run_id = os.environ.get('GITHUB_RUN_ID')
@@ -1661,9 +2432,86 @@ def create_review_and_summary_comment(review_context: ReviewContext, comments_fo
         # Use a direct link to the run instead of trying to link to the specific job
         # This is more reliable as the job ID format in URLs is numeric and not available directly
         run_log_url = f"https://github.com/{repo_name}/actions/runs/{run_id}"
-        summary_body += f"- [View workflow run log]({run_log_url})\n"
+        summary_parts.append(f"- [View workflow run log]({run_log_url})\n")
+
+    summary_body = "".join(summary_parts)
 
-    # Post the summary comment
+    # Process and post review comments. For PRs the summary goes out as the review body, so the
+    # review and its summary are a single API call.
+    summary_posted = False
+    if num_suggestions > 0:
+        valid_review_comments = []
+        for c in comments_for_gh_review:
+            if all(k in c for k in ["body", "path", "position"]):
+                if isinstance(c["position"], int) and isinstance(c["path"], str) and isinstance(c["body"], str):
+                    valid_review_comments.append({
+                        "body": c["body"],
+                        "path": c["path"],
+                        "position": c["position"]
+                    })
+                else:
+                    logger.warning(f"Skipping malformed comment due to type mismatch: {c}")
+            else:
+                logger.warning(f"Skipping malformed comment due to missing keys: {c}")
+
+        if valid_review_comments:
+            if review_context.event_type == "pull_request" and review_context.pr_obj:
+                try:
+                    logger.info(f"Creating a PR review with {len(valid_review_comments)} suggestions.")
+                    target_obj.create_review(
+                        body=summary_body,
+                        event="COMMENT",
+                        comments=valid_review_comments
+                    )
+                    summary_posted = True
+                    logger.info("Successfully created PR review with suggestions and summary.")
+                except GithubException as e:
+                    logger.error("Error creating PR review: %s (Status: %s, Data: %s)", e, getattr(e, 'status', 'N/A'), getattr(e, 'data', 'N/A'), exc_info=True)
+                    logger.warning("Falling back to posting individual issue comments for suggestions.")
+                    for c_item in valid_review_comments:
+                        try:
+                            # For PRs, issue comments are tied to the PR number
+                            target_obj.create_issue_comment(f"I found an issue in **File:** `{c_item['path']}` (at diff position {c_item['position']})\n\n{c_item['body']}")
+                        except Exception as ie:
+                            logger.error("Error posting individual suggestion as issue comment: %s", ie, exc_info=True)
+                except Exception as e:
+                    logger.exception("Unexpected error during PR review creation: %s", e)
+            elif review_context.event_type == "push" and review_context.commit_obj:
+                # For push events, comments are posted directly on the commit
+                logger.info(f"Creating {len(valid_review_comments)} comments on commit {review_context.commit_sha}.")
+                for c_item in valid_review_comments:
+                    try:
+                        # Commit comments require path, position, and commit_id
+                        # The 'position' here is the position in the diff, which needs to be calculated
+                        # relative to the target commit.
+                        # For now, we'll simplify and post as general commit comments if direct diff comment is complex.
+                        # GitHub API for commit comments: POST /repos/{owner}/{repo}/commits/{commit_sha}/comments
+                        # This requires `path` and `position` relative to the diff of that commit.
+                        # The `position` from our `improved_calculate_github_position` is for PR diffs.
+                        # For simplicity, we'll post general comments on the commit, or if we want file-specific,
+                        # we can try `create_comment` on the commit object.
+                        # The `position` parameter for `create_comment` on a commit refers to the line number in the *file*,
+                        # not the diff position. This is a key difference.
+                        # For now, let's post as a general comment on the commit, mentioning the file and diff position.
+                        target_obj.create_comment(
+                            body=f"I found an issue in **File:** `{c_item['path']}` (at diff position {c_item['position']})\n\n{c_item['body']}",
+                            path=c_item['path'], # Path relative to the repository root
+                            position=c_item['position'], # Line number in the file (not diff position)
+                            commit_id=review_context.commit_sha
+                        )
+                        logger.info(f"Posted comment on commit {review_context.commit_sha} for file {c_item['path']}.")
+                    except GithubException as e:
+                        logger.error("Error posting commit comment for %s: %s (Status: %s, Data: %s)", c_item['path'], e, getattr(e, 'status', 'N/A'), getattr(e, 'data', 'N/A'), exc_info=True)
+                    except Exception as e:
+                        logger.exception("Unexpected error posting commit comment for %s: %s", c_item['path'], e)
+            else:
+                logger.warning("No validly structured comments to create a review with.")
+        else:
+            logger.info("No suggestions to create a review for.")
+
+    # Post the summary comment, unless it already went out as the review body
+    if summary_posted:
+        return
     try:
         if target_obj:
             if review_context.event_type == "pull_request" or review_context.event_type == "issue_comment":
@@ -1673,32 +2521,171 @@ def create_review_and_summary_comment(review_context: ReviewContext, comments_fo
                 except GithubException as e:
                     logger.error("Error creating summary comment on PR/Issue: %s (Status: %s, Data: %s)", e, getattr(e, 'status', 'N/A'), getattr(e, 'data', 'N/A'), exc_info=True)
                 except Exception as e:
-                    logger.error("Unexpected error creating summary comment on PR/Issue: %s", e, exc_info=True)
-                    traceback.print_exc()
+                    logger.exception("Unexpected error creating summary comment on PR/Issue: %s", e)
             elif review_context.event_type == "push":
                 logger.warning("Summary comments are not directly supported for bare commits via create_issue_comment. Skipping summary comment.")
                 # The review results are still saved to the JSON file.
         else:
             logger.error("Cannot post summary comment: No valid target object (PR or Commit) available.")
     except Exception as e:
-        logger.error("Unhandled error during summary comment posting: %s", e, exc_info=True)
-        traceback.print_exc()
+        logger.exception("Unhandled error during summary comment posting: %s", e)
+
+
+def skip_removed_file_diffs(diff_lines: Iterable[str]) -> Iterator[str]:
+    """
+    Yield the lines of a git diff, dropping the sections of deleted files.
+
+    Deleted files are never reviewed, so their hunks are skipped before unidiff tokenizes them. A
+    file section's extended header (the lines between "diff --git" and the first "---", "@@" or
+    "Binary files" line) is buffered until it's known whether it contains "deleted file mode".
+    """
+    header: List[str] = []
+    skipping = False
+    for line in diff_lines:
+        if line.startswith("diff --git "):
+            yield from header
+            header = [line]
+            skipping = False
+        elif skipping:
+            continue
+        elif header:
+            if line.startswith("deleted file mode"):
+                header = []
+                skipping = True
+            elif line.startswith(("--- ", "@@", "Binary files")):
+                yield from header
+                header = []
+                yield line
+            else:
+                header.append(line)
+        else:
+            yield line
+    yield from header
 
 
 def parse_diff_to_patchset(diff_text: str) -> Optional[PatchSet]:
     if not diff_text:
-        print("No diff text to parse.")
+        logger.info("No diff text to parse.")
         return None
     try:
-        patch_set = PatchSet(diff_text)
-        print(f"Diff parsed into PatchSet with {len(list(patch_set))} patched files.")
+        patch_set = PatchSet(skip_removed_file_diffs(diff_text.splitlines(keepends=True)))
+        logger.info("Diff parsed into PatchSet with %d patched files.", len(patch_set))
         return patch_set
     except Exception as e:
-        print(f"Error parsing diff string with unidiff: {type(e).__name__} - {e}")
-        print(f"Diff text that failed (first 1000 chars): {diff_text[:1000]}")
+        logger.error("Error parsing diff string with unidiff: %s - %s", type(e).__name__, e)
+        logger.debug("Diff text that failed (first 1000 chars): %s", diff_text[:1000])
     return None
 
 
+# "*.<ext>" globs are the bulk of typical exclude lists; they are answered with a dict lookup
+# on the file extension instead of a regex match.
+_EXTENSION_GLOB_RE = re.compile(r"\*\.([A-Za-z0-9]+)")
+
+# Other slash-free globs of the form "*<literal suffix>" match a full path exactly when they match
+# its basename, since the leading "*" absorbs any directory prefix. Those can be tested against the
+# (short) basename; every other glob needs the full path.
+_BASENAME_GLOB_RE = re.compile(r"\*[^/*?\[]*")
+
+
+def normalize_diff_path(path: str) -> str:
+    """Strip a leading "./" (or "/") from a diff path without touching dot-directories like .github."""
+    while path.startswith("./"):
+        path = path[2:]
+    return path.lstrip("/")
+
+
+@functools.lru_cache(maxsize=256)
+def _exclude_glob_to_regex(pattern: str) -> str:
+    # fnmatch.translate dominates compile cost, so it's cached per glob across INPUT_EXCLUDE values.
+    # As in .gitignore, a trailing "/" names a directory and excludes everything under it
+    if pattern.endswith("/"):
+        pattern += "*"
+    return fnmatch.translate(pattern)
+
+
+def _compile_union_regex(patterns: List[str], indices: List[int]):
+    if not indices:
+        return None
+    return re.compile("|".join(f"(?P<_{i}>{_exclude_glob_to_regex(patterns[i])})" for i in indices))
+
+
+class ExcludeMatcher:
+    """
+    Shell-style exclude globs, compiled so each path costs one dict lookup and at most two regex matches.
+
+    "*.<ext>" globs go into an extension -> pattern dict. Other suffix globs such as "*.min.js" go
+    into a union regex matched against the file's basename, and all remaining globs into a union
+    regex matched against the full normalized path; a glob ending in "/" (e.g. "vendor/") excludes
+    the whole directory. In the union regexes every glob is a named alternative (_0, _1, ...)
+    numbered by its position in `patterns`, so match.lastgroup identifies the excluding pattern.
+    """
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+        self.extension_patterns: Dict[str, str] = {}
+        basename_indices: List[int] = []
+        path_indices: List[int] = []
+        for i, pattern in enumerate(patterns):
+            extension_glob = _EXTENSION_GLOB_RE.fullmatch(pattern)
+            if extension_glob:
+                self.extension_patterns.setdefault(extension_glob.group(1), pattern)
+            elif _BASENAME_GLOB_RE.fullmatch(pattern):
+                basename_indices.append(i)
+            else:
+                path_indices.append(i)
+        self.basename_re = _compile_union_regex(patterns, basename_indices)
+        self.path_re = _compile_union_regex(patterns, path_indices)
+
+    def match(self, normalized_path: str) -> Optional[str]:
+        """Return the first pattern found to exclude `normalized_path`, or None."""
+        basename = normalized_path.rpartition("/")[2]
+        _, dot, extension = basename.rpartition(".")
+        if dot and extension in self.extension_patterns:
+            return self.extension_patterns[extension]
+        match = None
+        if self.basename_re is not None:
+            match = self.basename_re.match(basename)
+        if match is None and self.path_re is not None:
+            match = self.path_re.match(normalized_path)
+        if match is None:
+            return None
+        return self.patterns[int(match.lastgroup[1:])]
+
+
+def compile_exclude_patterns(patterns: List[str]) -> Optional[ExcludeMatcher]:
+    """Compile exclude globs into an ExcludeMatcher, or None when there are no patterns."""
+    if not patterns:
+        return None
+    return ExcludeMatcher(patterns)
+
+
+@functools.lru_cache(maxsize=8)
+def get_exclude_matcher(exclude_patterns_str: str) -> Optional[ExcludeMatcher]:
+    """
+    Parse a comma-separated INPUT_EXCLUDE value and compile it, once per distinct value.
+
+    Keyed on the raw string, so a long-lived process reviewing many events with the same
+    configuration compiles the globs once, and a changed value simply misses the cache. Patterns
+    get the same leading "./" stripping as diff paths, so "./docs/*" matches "docs/a.md".
+    """
+    patterns = (normalize_diff_path(p.strip()) for p in exclude_patterns_str.split(','))
+    return compile_exclude_patterns([p for p in patterns if p])
+
+
+def review_json_path(review_context: ReviewContext) -> str:
+    """Path of the review JSON file for this event (PR reviews and commit reviews are kept separately)."""
+    if review_context.event_type == "pull_request":
+        return "reviews/gemini-pr-review.json"
+    return "reviews/gemini-commit-review.json"
+
+
+def emit_empty_review(review_context: ReviewContext, reason: str) -> None:
+    """Log why nothing was reviewed, then write the empty review file and post the summary once."""
+    logger.info(reason)
+    review_file_path = review_json_path(review_context)
+    save_review_results_to_json(review_context, [], review_file_path)
+    create_review_and_summary_comment(review_context, [], review_file_path)
+
+
 def main():
     """
     Main function to run the AI code review process.
@@ -1719,7 +2706,8 @@ def main():
     logger.info("Starting AI Code Review Script...")
 
     # Validate that clients are available
-    if not gh or not gemini_client_module:
+    github_client, _, gemini_module = get_clients()
+    if not github_client or not gemini_module:
         logger.error("GitHub or Gemini client not available. Exiting.")
         raise ValueError("GitHub or Gemini client not available")
 
@@ -1734,40 +2722,38 @@ def main():
         base_sha = None
         
         if review_context.event_type == "pull_request":
-            head_sha = review_context.pr_obj.head.sha if review_context.pr_obj and review_context.pr_obj.head else None
-            base_sha = review_context.pr_obj.base.sha if review_context.pr_obj and review_context.pr_obj.base else None
+            head_sha = review_context.head_sha
+            base_sha = review_context.base_sha
             
             last_run_sha_from_env = os.environ.get("LAST_RUN_SHA", "").strip()
 
-            if review_context.event_type in ["opened", "reopened"]:
+            if review_context.action in ["opened", "reopened"]:
                 comparison_sha_for_diff = base_sha
-                logger.info(f"Event type is '{review_context.event_type}'. Reviewing full PR against base SHA: {comparison_sha_for_diff}")
-            elif review_context.event_type == "synchronize":
-                if last_run_sha_from_env and last_run_sha_from_env != head_sha:
+                logger.info(f"PR action is '{review_context.action}'. Reviewing full PR against base SHA: {comparison_sha_for_diff}")
+            elif review_context.action == "synchronize":
+                if last_run_sha_from_env and last_run_sha_from_env == head_sha:
+                    # Already reviewed this head; don't fall back to fetching the full PR diff
+                    emit_empty_review(review_context, f"PR action is 'synchronize', but last_run_sha ({last_run_sha_from_env}) is the same as head_sha. No new commits to review.")
+                    return
+                if last_run_sha_from_env:
                     comparison_sha_for_diff = last_run_sha_from_env
-                    logger.info(f"Event type is 'synchronize'. Reviewing changes since last run SHA: {comparison_sha_for_diff}")
+                    logger.info(f"PR action is 'synchronize'. Reviewing changes since last run SHA: {comparison_sha_for_diff}")
                 else:
                     comparison_sha_for_diff = base_sha
-                    if not last_run_sha_from_env:
-                        logger.info(f"Event type is 'synchronize', but no last_run_sha found. Reviewing full PR against base SHA: {comparison_sha_for_diff}")
-                    elif last_run_sha_from_env == head_sha:
-                        logger.info(f"Event type is 'synchronize', but last_run_sha ({last_run_sha_from_env}) is same as head_sha. No new commits for incremental review. Defaulting to full review against base SHA: {comparison_sha_for_diff}.")
+                    logger.info(f"PR action is 'synchronize', but no last_run_sha found. Reviewing full PR against base SHA: {comparison_sha_for_diff}")
             else:
                 comparison_sha_for_diff = base_sha
-                logger.info(f"Event type is '{review_context.event_type}'. Defaulting to full review against base SHA: {comparison_sha_for_diff}")
+                logger.info(f"PR action is '{review_context.action}'. Defaulting to full review against base SHA: {comparison_sha_for_diff}")
 
             if head_sha == comparison_sha_for_diff:
-                logger.info(f"HEAD SHA ({head_sha}) is the same as comparison SHA ({comparison_sha_for_diff}). No new changes to diff.")
-                save_review_results_to_json(review_context, [], "reviews/gemini-pr-review.json")
-                create_review_and_summary_comment(review_context, [], "reviews/gemini-pr-review.json")
-                logger.info("Exiting as there are no new changes to review based on SHAs.")
+                emit_empty_review(review_context, f"HEAD SHA ({head_sha}) is the same as comparison SHA ({comparison_sha_for_diff}). No new changes to review.")
                 return
 
             diff_text = get_diff(review_context, comparison_sha_for_diff)
 
         elif review_context.event_type == "push":
-            head_sha = review_context.commit_sha
-            commit_review_filepath = "reviews/gemini-commit-review.json"
+            head_sha = review_context.head_sha
+            commit_review_filepath = review_json_path(review_context)
             last_reviewed_commit_sha = None
 
             # Attempt to load last reviewed commit SHA from the review file
@@ -1786,23 +2772,14 @@ def main():
                 logger.info(f"Event type is 'push'. No previous commit SHA or same as head. Reviewing commit {head_sha} against parent {comparison_sha_for_diff}.")
                 diff_text = get_diff(review_context, comparison_sha_for_diff)
             else:
-                logger.warning(f"Push event for commit {head_sha} has no parent and no previous commit SHA to compare against. No diff to review.")
-                save_review_results_to_json(review_context, [], commit_review_filepath)
-                create_review_and_summary_comment(review_context, [], commit_review_filepath)
-                return
-
-            # If diff_text is still empty after trying all comparisons, exit
-            if not diff_text:
-                logger.warning("No diff content retrieved for push event. Exiting review process.")
-                save_review_results_to_json(review_context, [], commit_review_filepath)
-                create_review_and_summary_comment(review_context, [], commit_review_filepath)
+                emit_empty_review(review_context, f"Push event for commit {head_sha} has no parent and no previous commit SHA to compare against. No diff to review.")
                 return
 
         elif review_context.event_type == "issue_comment":
             # For issue_comment events, we assume it's on a PR and re-review the PR
             if review_context.pr_obj:
-                head_sha = review_context.pr_obj.head.sha
-                base_sha = review_context.pr_obj.base.sha
+                head_sha = review_context.head_sha
+                base_sha = review_context.base_sha
                 comparison_sha_for_diff = base_sha # Always review full PR on issue_comment
                 logger.info(f"Event type is 'issue_comment' on PR #{review_context.pull_number}. Re-reviewing full PR against base SHA: {comparison_sha_for_diff}")
                 diff_text = get_diff(review_context, comparison_sha_for_diff)
@@ -1811,41 +2788,37 @@ def main():
                 return
         
         if not diff_text:
-            logger.warning("No diff content retrieved. Exiting review process.")
-            review_file_path = "reviews/gemini-pr-review.json" if review_context.event_type == "pull_request" else "reviews/gemini-commit-review.json"
-            save_review_results_to_json(review_context, [], review_file_path)
-            create_review_and_summary_comment(review_context, [], review_file_path)
+            emit_empty_review(review_context, "No diff content retrieved. Exiting review process.")
             return
 
-        # Parse the diff
-        initial_patch_set = parse_diff_to_patchset(diff_text)
+        # Parse the diff (the direct API strategy hands back an already-parsed PatchSet)
+        initial_patch_set = diff_text if isinstance(diff_text, PatchSet) else parse_diff_to_patchset(diff_text)
         if not initial_patch_set:
             logger.error("Failed to parse diff into PatchSet. Exiting.")
-            review_file_path = "reviews/gemini-pr-review.json" if review_context.event_type == "pull_request" else "reviews/gemini-commit-review.json"
-            save_review_results_to_json(review_context, [], review_file_path)
+            save_review_results_to_json(review_context, [], review_json_path(review_context))
             raise ValueError("Failed to parse diff into PatchSet")
 
         # Filter files to analyze
-        exclude_patterns_str = os.environ.get("INPUT_EXCLUDE", "")
-        exclude_patterns = [p.strip() for p in exclude_patterns_str.split(',') if p.strip()]
+        exclude_matcher = get_exclude_matcher(os.environ.get("INPUT_EXCLUDE", ""))
 
         actual_files_to_process: List[PatchedFile] = []
         for patched_file_obj in initial_patch_set:
-            normalized_path = patched_file_obj.path.lstrip('./')
+            # PatchedFile.path is a property that re-derives the path on every access, so read it once
+            path = patched_file_obj.path
+            normalized_path = normalize_diff_path(path)
             is_excluded = False
 
             if patched_file_obj.is_removed_file or (patched_file_obj.is_added_file and patched_file_obj.target_file == '/dev/null'):
-                logger.info(f"Skipping removed file (or added as /dev/null): {patched_file_obj.path}")
+                logger.info(f"Skipping removed file (or added as /dev/null): {path}")
                 is_excluded = True
             elif patched_file_obj.is_binary_file:
-                logger.info(f"Excluding binary file: {patched_file_obj.path}")
+                logger.info(f"Excluding binary file: {path}")
                 is_excluded = True
-            else:
-                for pattern in exclude_patterns:
-                    if fnmatch.fnmatch(normalized_path, pattern) or fnmatch.fnmatch(patched_file_obj.path, pattern):
-                        logger.info(f"Excluding file '{patched_file_obj.path}' due to pattern '{pattern}'.")
-                        is_excluded = True
-                        break
+            elif exclude_matcher is not None:
+                pattern = exclude_matcher.match(normalized_path)
+                if pattern is not None:
+                    logger.info(f"Excluding file '{path}' due to pattern '{pattern}'.")
+                    is_excluded = True
             if not is_excluded:
                 actual_files_to_process.append(patched_file_obj)
 
@@ -1853,17 +2826,14 @@ def main():
         logger.info(f"Number of files to analyze after exclusions: {num_files_to_analyze}")
 
         if num_files_to_analyze == 0:
-            logger.warning("No files to analyze after applying exclusion patterns.")
-            review_file_path = "reviews/gemini-pr-review.json" if review_context.event_type == "pull_request" else "reviews/gemini-commit-review.json"
-            save_review_results_to_json(review_context, [], review_file_path)
-            create_review_and_summary_comment(review_context, [], review_file_path)
+            emit_empty_review(review_context, "No files to analyze after applying exclusion patterns.")
             return
 
         # Analyze the code
         comments_for_gh_review_api = analyze_code(actual_files_to_process, review_context)
 
         # Save review results and create comments
-        review_json_filepath = "reviews/gemini-pr-review.json" if review_context.event_type == "pull_request" else "reviews/gemini-commit-review.json"
+        review_json_filepath = review_json_path(review_context)
         save_review_results_to_json(review_context, comments_for_gh_review_api, review_json_filepath)
         create_review_and_summary_comment(review_context, comments_for_gh_review_api, review_json_filepath)
 
@@ -1874,8 +2844,7 @@ def main():
         # We don't re-raise here as we want to handle these gracefully
     except Exception as e:
         # Unexpected errors
-        logger.error("Unexpected error in main process: %s", e, exc_info=True)
-        traceback.print_exc()
+        logger.exception("Unexpected error in main process: %s", e)
         # We don't re-raise here to avoid abrupt termination
 
 
@@ -1888,18 +2857,16 @@ if __name__ == "__main__":
     except Exception as e:
         # Catch any unhandled exceptions that weren't caught in main()
         logger.critical("Unhandled exception in __main__: %s - %s", type(e).__name__, e, exc_info=True)
-        traceback.print_exc()
 
         # Create an empty review file to avoid workflow failures
         try:
             # Get review context if possible
             try:
                 review_context = get_review_context()
-                review_file_path = "reviews/gemini-pr-review.json" if review_context.event_type == "pull_request" else "reviews/gemini-commit-review.json"
-                save_review_results_to_json(review_context, [], review_file_path)
+                save_review_results_to_json(review_context, [], review_json_path(review_context))
             except Exception:
                 # If we can't get review context, create a minimal review file
-                os.makedirs("reviews", exist_ok=True)
+                ensure_directory("reviews")
                 with open("reviews/gemini-pr-review.json", "w") as f: # Default to PR review file
                     json.dump({"metadata": {"error": str(e)}, "review_comments": []}, f)
         except Exception as file_error: